@@ -0,0 +1,203 @@
+# Latency and throughput benchmarks of the perception, decision and output stages,
+# run on the frames of a recording (robot_log.csv + IMG folder), compared to a stored baseline.
+# Example: $ python benchmark.py --save-baseline   (once, on the deployment machine)
+#          $ python benchmark.py                   (exit status 1 if a stage got slower)
+import argparse
+import json
+import os
+import platform
+import sys
+
+import cv2
+import numpy as np
+
+from perception import color_thresh, perspect_transform, rover_coords, pix_to_world, perception_step, \
+                       get_camera_model, source
+from decision import decision_step
+from supporting_functions import update_rover, create_output_images
+from process_dataset import read_log
+from profiler import StageProfiler
+from rover_state import RoverState, ground_truth
+from telemetry_sources import RecordingReplay, SimulatedClock, place_samples, SAMPLE_COUNT, FRAME_RATE
+
+# Benchmarked stages, in the order they are reported
+stages = ['color_thresh', 'perspect_transform', 'rover_coords', 'pix_to_world',
+          'update_rover', 'perception_step', 'decision_step', 'create_output_images']
+
+# A stage is only reported slower when its median is further above the baseline than this many
+# times the spread of the medians of the rounds (the run to run noise of the machine)
+NOISE_FACTOR = 2
+
+# Define a function to load the frames of a recording in memory, so reading files isn't measured
+def load_frames(log_path, max_frames):
+    frames = []
+    for img_path, xpos, ypos, yaw, pitch, roll in read_log(log_path)[:max_frames]:
+        img = cv2.cvtColor(cv2.imread(img_path), cv2.COLOR_BGR2RGB)
+        frames.append((img, xpos, ypos, yaw))
+    return frames
+
+# Notebook functions, one call per frame, on the same inputs as in the notebook
+def benchmark_functions(profiler, frames, rounds):
+    camera = get_camera_model(frames[0][0].shape)
+    for _ in range(rounds):
+        for img, xpos, ypos, yaw in frames:
+            with profiler.stage('perspect_transform'):
+                warped = perspect_transform(img, source, camera.destination)
+            with profiler.stage('color_thresh'):
+                threshed = color_thresh(warped, (160, 160, 160))
+            with profiler.stage('rover_coords'):
+                xpix, ypix = rover_coords(threshed)
+            with profiler.stage('pix_to_world'):
+                pix_to_world(xpix, ypix, xpos, ypos, yaw, 200, 10)
+
+# Control loop stages, on a rover fed with the telemetry of the recording
+def benchmark_pipeline(profiler, log_path, frame_count, rounds):
+    navigable = ground_truth > 0
+    replay = RecordingReplay(log_path, place_samples(navigable, SAMPLE_COUNT, np.random.RandomState(0)))
+    # Telemetry messages are built up front (they include the base64 camera images)
+    messages = []
+    for index in range(min(frame_count, len(replay))):
+        replay.index = index
+        messages.append(replay.telemetry())
+    for _ in range(rounds):
+        Rover = RoverState()
+        Rover.clock = SimulatedClock()
+        for data in messages:
+            with profiler.stage('update_rover'):
+                Rover, _ = update_rover(Rover, data)
+            with profiler.stage('perception_step'):
+                Rover = perception_step(Rover)
+            with profiler.stage('decision_step'):
+                Rover = decision_step(Rover)
+            with profiler.stage('create_output_images'):
+                create_output_images(Rover)
+            Rover.clock.time += 1.0 / FRAME_RATE
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def run_benchmarks(log_path, frame_count, rounds):
+    frames = load_frames(log_path, frame_count)
+    profiler = StageProfiler(history_size=len(frames) * rounds)
+    profiler.enabled = True
+    # One untimed round first, so one-time setup (camera model, lookup tables, caches) isn't measured
+    benchmark_functions(StageProfiler(), frames[:1], 1)
+    benchmark_pipeline(StageProfiler(), log_path, 1, 1)
+    benchmark_functions(profiler, frames, rounds)
+    benchmark_pipeline(profiler, log_path, len(frames), rounds)
+    summary = profiler.summary()
+    results = {}
+    for stage in stages:
+        stats = summary[stage]
+        # Median of each round (every round times each frame once, one after the other)
+        round_medians = np.median(profiler.timings[stage].reshape(rounds, -1), axis=1)
+        median = float(np.median(round_medians))
+        results[stage] = {
+            'count': stats['count'],
+            'median_ms': median,
+            'round_medians_ms': round_medians.tolist(),
+            # Relative spread of the medians of the rounds
+            'spread': float(np.ptp(round_medians) / median) if median > 0 else 0.0,
+            'mean_ms': stats['mean_ms'],
+            'max_ms': stats['max_ms'],
+            'percentiles_ms': stats['percentiles_ms'],
+            'calls_per_second': 1000 / stats['mean_ms'] if stats['mean_ms'] > 0 else float('inf'),
+        }
+    return {'environment': environment(), 'frames': len(frames), 'rounds': rounds, 'results': results}
+
+# Compare results to a baseline: a stage regressed if its median latency (over the medians of the
+# rounds) is slower than in the baseline by more than the tolerance (a fraction), or by more than
+# NOISE_FACTOR times the spread of the rounds measured in either run when that is larger
+def compare(results, baseline, tolerance):
+    regressions = []
+    print('{:<22}{:>14}{:>14}{:>10}{:>10}'.format('stage', 'baseline ms', 'current ms', 'ratio', 'allowed'))
+    for stage in stages:
+        current = results['results'][stage]
+        if 'median_ms' not in baseline['results'].get(stage, {}):
+            print('{:<22}{:>14}{:>14.3f}{:>10}{:>10}'.format(stage, '-', current['median_ms'], '-', '-'))
+            continue
+        previous = baseline['results'][stage]
+        ratio = current['median_ms'] / previous['median_ms'] if previous['median_ms'] > 0 else float('inf')
+        allowed = 1 + max(tolerance, NOISE_FACTOR * max(current['spread'], previous['spread']))
+        flag = ''
+        if ratio > allowed:
+            regressions.append(stage)
+            flag = '  REGRESSION'
+        print('{:<22}{:>14.3f}{:>14.3f}{:>10.2f}{:>10.2f}{}'.format(
+              stage, previous['median_ms'], current['median_ms'], ratio, allowed, flag))
+    if baseline.get('environment') != results['environment']:
+        print('Note: the baseline was measured in a different environment: {}'.format(baseline.get('environment')))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the control loop')
+    parser.add_argument(
+        '--log',
+        type=str,
+        default='../test_dataset/robot_log.csv',
+        help='Recording whose frames are used (robot_log.csv).'
+    )
+    parser.add_argument(
+        '--frames',
+        type=int,
+        default=0,
+        help='Number of frames of the recording to use (default: all of them).'
+    )
+    parser.add_argument(
+        '--rounds',
+        type=int,
+        default=5,
+        help='Number of times every frame goes through each stage (the median of each round is compared).'
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='../output/benchmark.json',
+        help='Path of the JSON file where the results are written.'
+    )
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default='../output/benchmark_baseline.json',
+        help='Results of a previous run to compare with.'
+    )
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='Store the results as the new baseline instead of comparing with it.'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.1,
+        help='Fraction by which the median latency of a stage can exceed the baseline, at least '
+             '(more when the rounds of the baseline or of this run vary more than that).'
+    )
+    args = parser.parse_args()
+
+    frame_count = args.frames if args.frames > 0 else sys.maxsize
+    results = run_benchmarks(args.log, frame_count, args.rounds)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print('Results written to {}'.format(args.output))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print('Baseline saved to {}'.format(args.baseline))
+    elif not os.path.isfile(args.baseline):
+        print('No baseline at {} (run with --save-baseline to create it)'.format(args.baseline))
+    else:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Slower than the baseline: {}'.format(', '.join(regressions)))
+            sys.exit(1)
@@ -0,0 +1,112 @@
+import numpy as np
+import cv2
+
+# Width of the single-row-ish remap tables. cv2.remap refuses maps with a
+# dimension of SHRT_MAX or more, so the visible pixels are laid out in rows
+# of this many pixels instead of one very long row.
+REMAP_TABLE_WIDTH = 1024
+
+# Width of the angular bins used to find the closest pixel in each direction (degrees)
+ANGLE_BIN_WIDTH = 1
+
+# Calibrated model of the rover camera: everything that only depends on the
+# perspective transform source/destination points is computed once here
+# instead of on every frame. Pixels of the top-down view further than max_range
+# (in top-down view pixels) from the rover are left out when it is given.
+class CameraModel():
+    def __init__(self, source, destination, img_shape, max_range=None):
+        self.source = np.float32(source)
+        self.destination = np.float32(destination)
+        self.img_shape = tuple(img_shape[:2])
+        rows, cols = self.img_shape
+
+        # Homography from the camera image to the top-down view
+        self.M = cv2.getPerspectiveTransform(self.source, self.destination)
+
+        # For every pixel of the top-down view, find where it comes from in the camera image
+        ypos, xpos = np.mgrid[0:rows, 0:cols]
+        points = np.stack((xpos.ravel(), ypos.ravel(), np.ones(rows * cols)))
+        Minv = np.linalg.inv(self.M)
+        src = Minv.dot(points)
+        # Sign of the homogeneous coordinate for points in front of the camera
+        front = np.sign(Minv.dot(np.append(self.destination[0], 1))[2])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            map_x = (src[0] / src[2]).reshape(rows, cols)
+            map_y = (src[1] / src[2]).reshape(rows, cols)
+
+        # Warped pixels that actually see the camera image. The others are outside
+        # of the field of view (or beyond the horizon) and are always black.
+        self.visible = (src[2].reshape(rows, cols) * front > 0) \
+                     & (map_x >= 0) & (map_x <= cols - 1) \
+                     & (map_y >= 0) & (map_y <= rows - 1)
+        if max_range is not None:
+            self.visible &= (ypos - rows)**2 + (xpos - rows)**2 <= max_range**2
+        self.visible_y, self.visible_x = self.visible.nonzero()
+        self.visible_count = len(self.visible_y)
+        self.visible_index = np.ravel_multi_index((self.visible_y, self.visible_x), self.img_shape)
+
+        # Remap tables restricted to the visible pixels. The padding at the end points
+        # outside of the image so it only ever samples the (black) border.
+        padded_count = -(-self.visible_count // REMAP_TABLE_WIDTH) * REMAP_TABLE_WIDTH
+        self.map_x = np.full(padded_count, -1, dtype=np.float32)
+        self.map_y = np.full(padded_count, -1, dtype=np.float32)
+        self.map_x[:self.visible_count] = map_x[self.visible]
+        self.map_y[:self.visible_count] = map_y[self.visible]
+        self.map_x = self.map_x.reshape(-1, REMAP_TABLE_WIDTH)
+        self.map_y = self.map_y.reshape(-1, REMAP_TABLE_WIDTH)
+
+        # Rows of the camera image the visible pixels are interpolated from (the rest, like the sky,
+        # is never read), and remap tables for images cropped to them, by first row of the crop
+        self.first_source_row = int(np.floor(map_y[self.visible].min()))
+        self.end_source_row = min(int(np.floor(map_y[self.visible].max())) + 2, rows)
+        self.cropped_map_y = {0: self.map_y}
+
+        # Rover-centric coordinates of the visible pixels (same convention as rover_coords)
+        self.x_rover = np.absolute(self.visible_y - rows).astype(np.float64)
+        self.y_rover = -(self.visible_x - rows).astype(np.float64)
+        # and their polar coordinates (same as to_polar_coords)
+        self.dists = np.sqrt(self.x_rover**2 + self.y_rover**2)
+        self.angles = np.arctan2(self.y_rover, self.x_rover)
+
+        # Visible pixels sorted by angular bin, then by distance, so the closest pixel
+        # of a kind in every bin can be found with a single reduction (see range_sweep)
+        angle_bins = np.int_(np.floor(np.degrees(self.angles) / ANGLE_BIN_WIDTH))
+        self.bin_order = np.lexsort((self.dists, angle_bins))
+        self.bin_dists = self.dists[self.bin_order]
+        sorted_bins = angle_bins[self.bin_order]
+        self.bin_starts = np.flatnonzero(np.diff(sorted_bins, prepend=sorted_bins[0] - 1))
+        self.bin_angles = sorted_bins[self.bin_starts] * ANGLE_BIN_WIDTH # lower edge of each bin (degrees)
+        self.probe_windows = {} # probe angles and half width -> bins covered by each probe
+
+    # Rows of the camera image read by warp_visible, plus margin rows on each side
+    # (for filters that need the neighbouring pixels)
+    def source_rows(self, margin=0):
+        return slice(max(self.first_source_row - margin, 0), min(self.end_source_row + margin, self.img_shape[0]))
+
+    # Perspective transform of the visible pixels only, as a (visible_count, channels) array
+    # ordered like visible_y/visible_x. img is the camera image, or the rows of it from first_row on
+    # (that include source_rows())
+    def warp_visible(self, img, first_row=0):
+        if first_row not in self.cropped_map_y:
+            self.cropped_map_y[first_row] = self.map_y - np.float32(first_row)
+        warped = cv2.remap(img, self.map_x, self.cropped_map_y[first_row], cv2.INTER_LINEAR)
+        return warped.reshape(-1, img.shape[2])[:self.visible_count]
+
+    # Distance to the closest pixel of the mask (ordered like visible_y/visible_x) in every angular bin,
+    # np.inf for bins without any pixel of the mask
+    def range_sweep(self, mask):
+        dists = np.where(mask[self.bin_order], self.bin_dists, np.inf)
+        return np.minimum.reduceat(dists, self.bin_starts)
+
+    # Distance to the closest pixel of the mask within +/- half_width degrees of each probe angle,
+    # or far_away when there is none. Probes should be multiples of ANGLE_BIN_WIDTH.
+    def probe_distances(self, mask, probe_angles, half_width=3, far_away=9999):
+        key = (tuple(probe_angles), half_width)
+        if key not in self.probe_windows:
+            probes = np.asarray(probe_angles)[:,None]
+            self.probe_windows[key] = (self.bin_angles >= probes - half_width) \
+                                    & (self.bin_angles < probes + half_width)
+        windows = self.probe_windows[key]
+        distances = np.where(windows, self.range_sweep(mask), np.inf).min(axis=1)
+        distances[np.isinf(distances)] = far_away
+        return distances
@@ -1,31 +1,43 @@
+import enum
 import numpy as np
 import random
 from scipy.spatial import distance
-
-
-def is_initialize_state(Rover):
-    return Rover.mode in ['start']
-
-def initialize_state(Rover):
-    if Rover.mode == 'start':
-        if Rover.starting_pos is None:
-            Rover.starting_pos = Rover.pos
-        
-        if is_near_front_wall(Rover) or is_stuck(Rover):
-            Rover.mode = 'travel'
-        else:
-            maintain_high_speed(Rover)
-
-    return Rover
+from state_machine import StateMachine
+
+
+# Modes of the rover. They are strings too, so they compare equal to (and print as) their names.
+class Mode(str, enum.Enum):
+    START               = 'start'
+    TRAVEL              = 'travel'
+    BREAK_LOOP          = 'break_loop'
+    TURN_AWAY_ON_TRAVEL = 'turn_away_on_travel'
+    TURN_AWAY_ON_RETURN = 'turn_away_on_return'
+    UNSTUCK_ON_TRAVEL   = 'unstuck_on_travel'
+    UNSTUCK_ON_RETURN   = 'unstuck_on_return'
+    UNSTUCK_ON_PICKUP   = 'unstuck_on_pickup'
+    APPROACH_SAMPLE     = 'approach_sample'
+    PICKUP_SAMPLE       = 'pickup_sample'
+    RETURN_HOME         = 'return_home'
+    STOP                = 'stop'
+    IDLE                = 'idle'
+
+    def __str__(self):
+        return self.value
+
+
+def start_state(Rover, resume):
+    if Rover.starting_pos is None:
+        Rover.starting_pos = tuple(Rover.pos) # a copy, not the list of the rover
+    
+    if is_near_front_wall(Rover) or is_stuck(Rover):
+        return Mode.TRAVEL
+    maintain_high_speed(Rover)
 
 def save_starting_position(Rover):
-    Rover.starting_pos = Rover.pos
-
-def is_travel_state(Rover):
-    return Rover.mode in ['travel', 'break_loop']
+    Rover.starting_pos = tuple(Rover.pos)
 
 def is_near_front_wall(Rover):
-    return Rover.front_wall_distance < 25
+    return Rover.front_wall_distance < Rover.front_wall_near
 
 def brake_until_stop(Rover):
     Rover.throttle = 0
@@ -60,23 +72,34 @@ def steer_left_lightly(Rover):
 
 
 def is_near_left_wall(Rover):
-    return Rover.left_wall_distance < 20
+    return Rover.left_wall_distance < Rover.left_wall_near
 
 def is_too_close_to_left_wall(Rover):
-    return Rover.left_wall_distance < 10
+    return Rover.left_wall_distance < Rover.left_wall_too_close
 
 def is_too_close_to_front_wall(Rover):
-    return Rover.front_wall_distance < 10
+    return Rover.front_wall_distance < Rover.front_wall_too_close
 
 def is_near_right_wall(Rover):
-    return Rover.right_wall_distance < 20
+    return Rover.right_wall_distance < Rover.right_wall_near
 
 def is_too_close_to_right_wall(Rover):
-    return Rover.right_wall_distance < 10
+    return Rover.right_wall_distance < Rover.right_wall_too_close
 
 
 def is_too_far_from_left_wall(Rover):
-    return Rover.left_wall_distance > 35
+    return Rover.left_wall_distance > Rover.left_wall_far
+
+def is_heading_for_frontier(Rover):
+    return Rover.explorer is not None and Rover.explorer.goal is not None and not is_too_close_to_front_wall(Rover)
+
+# Explore the frontier of the mapped area if enabled, otherwise (or when there is no frontier to go to) follow the left wall
+def explore(Rover):
+    if Rover.explorer is None or not steer_toward_frontier(Rover):
+        crawl_to_left_wall(Rover)
+    elif is_near_front_wall(Rover):
+        maintain_moderate_speed(Rover)
+    return Rover
 
 def crawl_to_left_wall(Rover):
     if is_near_left_wall(Rover):
@@ -89,14 +112,11 @@ def crawl_to_left_wall(Rover):
 
 
 def is_sample_nearby(Rover):
-    return Rover.rock_size > 0 and Rover.rock_angle > -15 and Rover.rock_dist < 40
+    return Rover.rock_size > 0 and Rover.rock_angle > Rover.sample_min_angle and Rover.rock_dist < Rover.sample_near
 
 def finish_collecting(Rover):
     return Rover.samples_found >= 6
 
-def is_finalize_state(Rover):
-    return Rover.mode in ['return_home', 'stop']
-
 def steer_toward_starting_point(Rover):
     x1 = Rover.pos[0]
     y1 = Rover.pos[1]
@@ -110,85 +130,102 @@ def steer_toward_starting_point(Rover):
         Rover.steer = np.clip(yaw_angle_to_target, -15, 15)
         return False    
 
+# Steer along the path planned over the worldmap toward the starting point,
+# returns False while there is no path yet (or no path planner)
+def steer_along_path(Rover):
+    if Rover.path_planner is None:
+        return False
+    return steer_toward_waypoint(Rover, Rover.path_planner.next_waypoint(Rover.pos, Rover.starting_pos))
+
+# Steer toward the next frontier of the mapped area,
+# returns False when there is none or no path to it yet
+def steer_toward_frontier(Rover):
+    return steer_toward_waypoint(Rover, Rover.explorer.next_waypoint(Rover.pos))
+
+def steer_toward_waypoint(Rover, waypoint):
+    if waypoint is None:
+        return False
+    angle_to_waypoint = np.arctan2(waypoint[1] - Rover.pos[1], waypoint[0] - Rover.pos[0]) * 180 / np.pi
+    yaw_angle_to_target = (angle_to_waypoint - Rover.yaw + 180) % 360 - 180 # between -180 and 180
+    if abs(yaw_angle_to_target) > 45:
+        # way off, turn in place
+        Rover.throttle = 0
+    Rover.steer = np.clip(yaw_angle_to_target, -15, 15)
+    return True
+
 def is_near_starting_position(Rover):
     return distance.euclidean(Rover.pos, Rover.starting_pos) < 5
 
-def finalize_state(Rover):    
-    if Rover.mode == 'return_home':
-        if is_stuck(Rover):
-            Rover.mode = 'unstuck_on_return'
-        elif is_near_starting_position(Rover):
-            Rover.mode = 'stop'
-        else:
-            if is_near_front_wall(Rover):
-                maintain_moderate_speed(Rover)
-            else:
-                maintain_high_speed(Rover)
+def return_home_state(Rover, resume):
+    if is_stuck(Rover):
+        return Mode.UNSTUCK_ON_RETURN
+    if is_near_starting_position(Rover):
+        return Mode.STOP
 
-            steer_toward_starting_point(Rover)
+    if is_near_front_wall(Rover):
+        maintain_moderate_speed(Rover)
+    else:
+        maintain_high_speed(Rover)
 
-            if is_near_left_wall(Rover):
-                steer_right(Rover)
-            elif is_near_right_wall(Rover):
-                steer_left(Rover)
+    if not steer_along_path(Rover):
+        # no path (yet), head for the starting point and away from the walls
+        steer_toward_starting_point(Rover)
 
-            if is_too_close_to_front_wall(Rover):
-                if brake_until_stop(Rover):
-                    Rover.mode = 'turn_away_on_return'
+        if is_near_left_wall(Rover):
+            steer_right(Rover)
+        elif is_near_right_wall(Rover):
+            steer_left(Rover)
 
-    elif Rover.mode == 'stop':
+    if is_too_close_to_front_wall(Rover):
         if brake_until_stop(Rover):
-            stand_still(Rover)
-            Rover.mode = 'idle'
+            return Mode.TURN_AWAY_ON_RETURN
 
-    return Rover
+def stop_state(Rover, resume):
+    if brake_until_stop(Rover):
+        stand_still(Rover)
+        return Mode.IDLE
 
+def idle_state(Rover, resume):
+    pass
 
 
-def travel_state(Rover):
-    if Rover.mode == 'travel':
-        if is_stuck(Rover):
-            Rover.mode = 'unstuck_on_travel'
-        elif is_circling(Rover):
-            Rover.mode = 'break_loop'
-        elif finish_collecting(Rover):
-            Rover.mode = 'return_home'
-        else:        
-            if is_near_front_wall(Rover):
-                maintain_moderate_speed(Rover)
-                if not is_too_close_to_right_wall(Rover):
-                    steer_right(Rover)
-                else:
-                    if brake_until_stop(Rover):
-                        Rover.mode = 'turn_away_on_travel' # out of "travel" state and into "avoid" state
-            else:
-                if is_sample_in_sight(Rover):
-                    maintain_moderate_speed(Rover)
-                    if is_sample_nearby(Rover):
-                        if brake_until_stop(Rover):
-                            Rover.target_rock_pos = Rover.rock_pos
-                            Rover.mode = 'approach_sample'
-                    else:
-                        crawl_to_left_wall(Rover)
-                else:
-                    maintain_high_speed(Rover)
-                    crawl_to_left_wall(Rover)
-    elif Rover.mode == 'break_loop':
-        Rover.steer = 0
-        if is_stuck(Rover):
-            Rover.mode = 'travel'
-        else:
-            if is_near_front_wall(Rover):
-                Rover.mode = 'travel'
-            else:
-                maintain_high_speed(Rover)
-            
 
-    return Rover
+def travel_state(Rover, resume):
+    if is_stuck(Rover):
+        return Mode.UNSTUCK_ON_TRAVEL
+    if is_circling(Rover):
+        return Mode.BREAK_LOOP
+    if finish_collecting(Rover):
+        return Mode.RETURN_HOME
 
+    # When heading for a frontier, the planned path already keeps away from the walls
+    if is_near_front_wall(Rover) and not is_heading_for_frontier(Rover):
+        maintain_moderate_speed(Rover)
+        if not is_too_close_to_right_wall(Rover):
+            steer_right(Rover)
+        else:
+            if brake_until_stop(Rover):
+                return Mode.TURN_AWAY_ON_TRAVEL # out of "travel" state and into "avoid" state
+    else:
+        if is_sample_in_sight(Rover):
+            maintain_moderate_speed(Rover)
+            if is_sample_nearby(Rover):
+                if brake_until_stop(Rover):
+                    # The fused position of the rock is steadier than the one of this frame
+                    target = Rover.rock_registry.nearest_uncollected(Rover.pos)
+                    Rover.target_rock_pos = Rover.rock_pos if target is None else target
+                    return Mode.APPROACH_SAMPLE
+            else:
+                explore(Rover)
+        else:
+            maintain_high_speed(Rover)
+            explore(Rover)
 
-def is_avoid_state(Rover):
-    return Rover.mode in ['turn_away_on_travel', 'turn_away_on_return', 'unstuck_on_travel', 'unstuck_on_return', 'unstuck_on_pickup']
+def break_loop_state(Rover, resume):
+    Rover.steer = 0
+    if is_stuck(Rover) or is_near_front_wall(Rover):
+        return resume
+    maintain_high_speed(Rover)
 
 def stand_still(Rover):
     Rover.throttle = 0
@@ -196,77 +233,59 @@ def stand_still(Rover):
     Rover.brake = 0
 
 
+# How long spin_back reverses and turns (seconds, 50 to 500 frames at the usual 25 FPS)
+SPIN_BACK_TIMES = [2, 4, 8, 12, 20]
+
 def spin_back(Rover):
     Rover.brake = 0
     
-    if Rover.spin_back_counter == 0:
+    if Rover.spin_back_until is None:
         Rover.throttle = random.choice([0, 0, 0, 0, -0.1, -0.2, -0.3, -0.4]) # more chance for it to turn around without moving
         Rover.steer = random.choice([-15, -10, -5, 5, 10, 15])
-        Rover.spin_back_counter = random.choice([50, 100, 200, 300, 500])
-    
-    if Rover.spin_back_counter > 0:
-        Rover.spin_back_counter -= 1
+        Rover.spin_back_until = Rover.total_time + random.choice(SPIN_BACK_TIMES)
         # if is_stuck(Rover): # if stuck while reversing, then go forward instead
         #     Rover.throttle *= -1
         
-    if Rover.spin_back_counter == 0:
+    if Rover.total_time >= Rover.spin_back_until:
+        Rover.spin_back_until = None
+        # the turns of the spin back don't count as circling once it's done
+        Rover.motion_history.reset()
         Rover.throttle = 0
         Rover.steer = 0
         return True
     else:
         return False    
 
+# Stuck: trying to move (throttle on) during STUCK_TIME seconds without getting further than dist meters
+STUCK_TIME = 3
+# Circling: turned all the way around within CIRCLING_TIME seconds without leaving a circle of CIRCLING_RADIUS meters
+CIRCLING_TIME = 20
+CIRCLING_RADIUS = 10
+
 def is_stuck(Rover, dist = None):
-    if Rover.marked_pos is None:
-        Rover.marked_pos = Rover.pos
-        Rover.unmoveable_counter = 200
-
-    if Rover.unmoveable_counter > 0:
-         Rover.unmoveable_counter -= 1
-         return False # not enough time to know if it's stuck yet, so assume not
-    else: 
-        # waited long enough for unmoveable_counter to get down to zero,
-        # now calculate if it moved anywhere ever since.        
-        delta_x = Rover.pos[0] - Rover.marked_pos[0]
-        delta_y = Rover.pos[1] - Rover.marked_pos[1]
-
-        Rover.marked_pos = None
-        if dist is None:
-            dist = 0.05
-        return abs(delta_x) < dist and abs(delta_y) < dist # == true if it didn't move much
-
-
-    # if abs(Rover.vel) < 0.1:
-    #     if Rover.throttle != 0:
-    #         Rover.unmoveable_counter += 1
-
-    # if Rover.unmoveable_counter > 100:
-    #     Rover.unmoveable_counter = 0
-    #     return True
-    # else:
-    #     if Rover.throttle == 0:
-    #         Rover.unmoveable_counter = 0 
-    #     return False
+    if dist is None:
+        dist = 0.05
+    history = Rover.motion_history
+    window = history.window(STUCK_TIME)
+    if window is None:
+        return False # not enough time to know if it's stuck yet, so assume not
+    if not history.throttle[window].any():
+        return False # it stopped (or turned in place) on purpose
+    if history.max_distance(window, Rover.pos) < dist:
+        history.reset()
+        return True
+    return False
 
 def is_circling(Rover):
-    if Rover.steer == 0:
-        return False
-
-    if  Rover.previous_steer is not None and Rover.previous_steer == Rover.steer:
-        Rover.continuous_steer_counter += 1
-    else:
-        Rover.previous_steer = Rover.steer
-        Rover.continuous_steer_counter = 0
-
-
-    if Rover.continuous_steer_counter > 500:
-        Rover.continuous_steer_counter = 0
+    if Rover.steer == 0 or Rover.spin_back_until is not None:
+        return False # going straight, or turning on purpose to get unstuck
+    history = Rover.motion_history
+    # No need to wait for the whole window, a full turn is enough
+    window = history.window(CIRCLING_TIME, partial=True)
+    if abs(history.total_turn(window)) >= 360 and history.max_distance(window, Rover.pos) < CIRCLING_RADIUS:
+        history.reset()
         return True
-    else:
-        if Rover.steer != Rover.previous_steer:
-            Rover.continuous_steer_counter = 0
-            Rover.previous_steer = None 
-        return False
+    return False
 
 
 
@@ -292,45 +311,20 @@ def brake_until_stop(Rover):
 def steer_until_clear(Rover):
     Rover.brake = 0
     Rover.steer = -30        
-    if Rover.front_wall_distance > 30:
+    if Rover.front_wall_distance > Rover.clear_distance:
         Rover.steer = 0        
         Rover.throttle = 0
         return True
     else:
         return False
 
-def avoid_state(Rover):    
-    if Rover.mode == 'turn_away_on_travel':
-        if turn_away_until_clear(Rover):
-            Rover.mode = 'travel'
-            
-    elif Rover.mode == 'turn_away_on_return':
-        if turn_away_until_clear(Rover):
-            Rover.mode = 'return_home'
-
-    elif Rover.mode == 'unstuck_on_travel':
-        if is_circling(Rover):
-            Rover.mode = 'break_loop'               
-        elif spin_back(Rover):        
-            Rover.mode = 'travel'
-
-    elif Rover.mode == 'unstuck_on_return':                
-        if is_circling(Rover):
-            Rover.mode = 'break_loop'               
-        elif spin_back(Rover):        
-            Rover.mode = 'return_home'
-
-    elif Rover.mode == 'unstuck_on_pickup':                
-        if is_circling(Rover):
-            Rover.mode = 'break_loop'               
-        elif spin_back(Rover):        
-            Rover.mode = 'approach_sample'
-
-    return Rover
+def turn_away_state(Rover, resume):
+    if turn_away_until_clear(Rover):
+        return resume
 
-
-def is_pickup_state(Rover):
-    return Rover.mode in ['approach_sample', 'pickup_sample']
+def unstuck_state(Rover, resume):
+    if spin_back(Rover):
+        return resume
 
 
 def look_for_sample(Rover):
@@ -360,18 +354,19 @@ def steer_right(Rover):
 
 def is_near_pickup_zone(Rover):
     # Rover.rock_angle > -15 means the rock is on the left side
-    return Rover.rock_size > 0 and Rover.rock_angle > -15 and Rover.rock_dist < 15
+    return Rover.rock_size > 0 and Rover.rock_angle > Rover.sample_min_angle and Rover.rock_dist < Rover.pickup_zone
 
 def is_in_pickup_zone(Rover):
     return Rover.near_sample
 
+# Returns the next mode once in the pickup zone or stuck on the way
 def get_in_pickup_zone(Rover): 
     if is_in_pickup_zone(Rover):            
         if brake_until_stop(Rover):
-            return True
+            return Mode.PICKUP_SAMPLE
     else:
         if is_stuck(Rover, 0.01): # minium delta distance is lower than default 0.05 since it's moving slower
-            Rover.mode = 'unstuck_on_pickup'            
+            return Mode.UNSTUCK_ON_PICKUP
         else:
             if is_near_pickup_zone(Rover):
                 maintain_slow_speed(Rover)
@@ -379,8 +374,6 @@ def get_in_pickup_zone(Rover):
                 maintain_moderate_speed(Rover)
             
             steer_toward_sample(Rover)
-                  
-    return False
 
 def pickup(Rover):
     if Rover.picking_up:
@@ -392,37 +385,46 @@ def pickup(Rover):
         else:
             return True
 
-def pickup_state(Rover):
-    if Rover.mode == 'approach_sample':
-        if not is_sample_in_sight(Rover): # somehow went pass it, then look back
-            if brake_until_stop(Rover):                
-                look_for_sample(Rover)
-        else:
-            if get_in_pickup_zone(Rover):
-                Rover.mode = 'pickup_sample'
-       
-    elif Rover.mode == 'pickup_sample':
-        if pickup(Rover):
-            Rover.mode = 'travel'
-
-    return Rover
-
+def approach_sample_state(Rover, resume):
+    if not is_sample_in_sight(Rover): # somehow went pass it, then look back
+        if brake_until_stop(Rover):                
+            look_for_sample(Rover)
+    else:
+        return get_in_pickup_zone(Rover)
 
+def pickup_sample_state(Rover, resume):
+    if pickup(Rover):
+        return Mode.TRAVEL
 
-def decision_step(Rover):
-    if is_initialize_state(Rover):
-        return initialize_state(Rover)
 
-    elif is_travel_state(Rover):
-        return travel_state(Rover)
 
-    elif is_avoid_state(Rover):
-        return avoid_state(Rover)
+# Handler of each mode, and the mode it goes back to when it is done (for the modes that
+# interrupt another one)
+states = {
+    Mode.START:               (start_state,           None),
+    Mode.TRAVEL:              (travel_state,          None),
+    Mode.BREAK_LOOP:          (break_loop_state,      Mode.TRAVEL),
+    Mode.TURN_AWAY_ON_TRAVEL: (turn_away_state,       Mode.TRAVEL),
+    Mode.TURN_AWAY_ON_RETURN: (turn_away_state,       Mode.RETURN_HOME),
+    Mode.UNSTUCK_ON_TRAVEL:   (unstuck_state,         Mode.TRAVEL),
+    Mode.UNSTUCK_ON_RETURN:   (unstuck_state,         Mode.RETURN_HOME),
+    Mode.UNSTUCK_ON_PICKUP:   (unstuck_state,         Mode.APPROACH_SAMPLE),
+    Mode.APPROACH_SAMPLE:     (approach_sample_state, None),
+    Mode.PICKUP_SAMPLE:       (pickup_sample_state,   None),
+    Mode.RETURN_HOME:         (return_home_state,     None),
+    Mode.STOP:                (stop_state,            None),
+    Mode.IDLE:                (idle_state,            None),
+}
 
-    elif is_pickup_state(Rover):
-        return pickup_state(Rover)
+state_machine = StateMachine(Mode, states)
 
-    elif is_finalize_state(Rover):
-        return finalize_state(Rover)
+# Modes that spin back, Rover.spin_back_until is only kept while in one of them
+unstuck_modes = [Mode.UNSTUCK_ON_TRAVEL, Mode.UNSTUCK_ON_RETURN, Mode.UNSTUCK_ON_PICKUP]
 
+def decision_step(Rover):
+    Rover.motion_history.record(Rover)
+    Rover = state_machine.step(Rover)
+    # A spin back that didn't run out (the mode was left another way) starts over next time
+    if Rover.mode not in unstuck_modes:
+        Rover.spin_back_until = None
     return Rover
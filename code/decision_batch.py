@@ -0,0 +1,214 @@
+# Vectorized version of the decisions of the travel mode, evaluated for many rover states and
+# many sets of decision parameters at once (arrays of states x arrays of parameter sets), to tune
+# the thresholds on recorded perception outputs instead of one simulator run at a time.
+# Example: $ python decision_batch.py ../output/telemetry.jsonl --sweep front_wall_near=15:40:5 \
+#                                      --sweep sample_near=20:60:10 --sweep throttle_set=0.1:0.4:0.05
+# (the telemetry log is recorded with drive_rover.py --log ../output/telemetry.jsonl --log-verbosity 2)
+import argparse
+import itertools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from decision import Mode
+from rover_params import decision_parameters
+
+# Fields of the rover state the travel decisions depend on. throttle, brake and steer are the
+# values before the decision (the previous commands).
+state_fields = ['vel', 'throttle', 'brake', 'steer', 'front_wall_distance', 'left_wall_distance',
+                'right_wall_distance', 'rock_size', 'rock_dist', 'rock_angle', 'samples_found']
+# Rover fields used as parameters by the travel decisions
+parameter_names = ['throttle_set', 'brake_set', 'max_vel', 'front_wall_near', 'left_wall_near', 'left_wall_far',
+                   'right_wall_too_close', 'sample_near', 'sample_min_angle']
+
+# Modes by index, next modes are returned as indices
+modes = list(Mode)
+mode_index = {mode: index for index, mode in enumerate(modes)}
+
+# Maximum number of (state, parameter set) pairs evaluated at once, to bound memory use
+CHUNK_SIZE = 1 << 20
+
+def steer_by(steer, angle):
+    return np.clip(steer + angle, -15, 15)
+
+# Same decisions as decision.travel_state with frontier exploration disabled, for states (dict of
+# arrays of N values) and parameters (dict of arrays of M values). stuck and circling states can
+# be given as boolean arrays (they depend on the history of the rover, not on the parameters).
+# Returns the throttle, brake, steer and next mode index as N x M arrays.
+def travel_decisions(states, parameters, stuck=None, circling=None):
+    S = {field: np.asarray(states[field], dtype=np.float64)[:, None] for field in state_fields}
+    P = {name: np.asarray(parameters[name], dtype=np.float64)[None, :] for name in parameter_names}
+    shape = (len(S['vel']), len(P['max_vel'][0]))
+    vel = S['vel']
+    stopped = vel == 0
+
+    near_front = S['front_wall_distance'] < P['front_wall_near']
+    too_close_right = S['right_wall_distance'] < P['right_wall_too_close']
+    in_sight = S['rock_size'] > 0
+    nearby = in_sight & (S['rock_angle'] > P['sample_min_angle']) & (S['rock_dist'] < P['sample_near'])
+    # brake_until_stop, then turn away from the front wall or approach the rock once stopped
+    braking = (near_front & too_close_right) | (~near_front & nearby)
+
+    moderate_throttle = np.where(vel > P['max_vel'] / 2, 0, P['throttle_set'] / 2)
+    high_throttle = np.where(vel > P['max_vel'], 0, P['throttle_set'])
+    throttle = np.where(braking, 0, np.where(near_front | in_sight, moderate_throttle, high_throttle))
+    brake = np.where(braking & ~stopped, P['brake_set'], 0)
+    # crawl_to_left_wall, or turn right away from the front wall
+    crawl_steer = np.where(S['left_wall_distance'] < P['left_wall_near'], steer_by(S['steer'], -15),
+                           np.where(S['left_wall_distance'] > P['left_wall_far'], steer_by(S['steer'], 15), 5))
+    steer = np.where(braking, 0, np.where(near_front, steer_by(S['steer'], -15), crawl_steer))
+    next_mode = np.where(braking & stopped,
+                         np.where(near_front, mode_index[Mode.TURN_AWAY_ON_TRAVEL], mode_index[Mode.APPROACH_SAMPLE]),
+                         mode_index[Mode.TRAVEL])
+
+    # Checked first by travel_state, which then leaves the commands as they are
+    leave = np.broadcast_to(S['samples_found'] >= 6, shape)
+    next_mode = np.where(leave, mode_index[Mode.RETURN_HOME], next_mode)
+    for condition, mode in ((circling, Mode.BREAK_LOOP), (stuck, Mode.UNSTUCK_ON_TRAVEL)):
+        if condition is not None:
+            condition = np.asarray(condition, dtype=bool)[:, None]
+            next_mode = np.where(condition, mode_index[mode], next_mode)
+            leave = leave | condition
+    throttle = np.where(leave, S['throttle'], throttle)
+    brake = np.where(leave, S['brake'], brake)
+    steer = np.where(leave, S['steer'], steer)
+    return (np.broadcast_to(throttle, shape), np.broadcast_to(brake, shape),
+            np.broadcast_to(steer, shape), np.broadcast_to(next_mode, shape))
+
+# Statistics of the decisions over all the states, for each parameter set. When the decisions
+# that were actually made are given (reference: dict of throttle, brake, steer and next mode index
+# arrays), the fraction of states where the same decision is made is included.
+def decision_statistics(states, parameters, stuck=None, circling=None, reference=None):
+    throttle, brake, steer, next_mode = travel_decisions(states, parameters, stuck, circling)
+    statistics = {
+        'mean_throttle': throttle.mean(axis=0),
+        'braking': (brake > 0).mean(axis=0),
+        'mean_abs_steer': np.abs(steer).mean(axis=0),
+        'turn_away': (next_mode == mode_index[Mode.TURN_AWAY_ON_TRAVEL]).mean(axis=0),
+        'approach_sample': (next_mode == mode_index[Mode.APPROACH_SAMPLE]).mean(axis=0),
+    }
+    if reference is not None:
+        same = (np.isclose(throttle, reference['throttle'][:, None])
+                & np.isclose(brake, reference['brake'][:, None])
+                & np.isclose(steer, reference['steer'][:, None])
+                & (next_mode == reference['next_mode'][:, None]))
+        statistics['agreement'] = same.mean(axis=0)
+    return statistics
+
+# decision_statistics over many parameter sets, in chunks evaluated by a pool of threads
+# (numpy releases the GIL in the array operations, so the chunks run on several cores)
+def sweep(states, parameters, stuck=None, circling=None, reference=None, workers=4):
+    state_count = len(states['vel'])
+    set_count = len(parameters['max_vel'])
+    chunk = max(CHUNK_SIZE // max(state_count, 1), 1)
+    def evaluate(start):
+        chunk_parameters = {name: values[start:start + chunk] for name, values in parameters.items()}
+        return decision_statistics(states, chunk_parameters, stuck, circling, reference)
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        results = list(pool.map(evaluate, range(0, set_count, chunk)))
+    return {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+
+# Cartesian product of the swept values of some parameters, the others keep their default value.
+# Returns a dict of arrays with one value per parameter set.
+def parameter_grid(defaults, swept):
+    names = list(swept)
+    combinations = list(itertools.product(*(swept[name] for name in names)))
+    parameters = {name: np.full(len(combinations), defaults[name], dtype=np.float64) for name in parameter_names}
+    for index, name in enumerate(names):
+        parameters[name] = np.array([combination[index] for combination in combinations], dtype=np.float64)
+    return parameters
+
+# Travel mode decisions recorded in a telemetry log (drive_rover.py --log-verbosity 2, every frame).
+# The state before a decision is the perception of a frame with the commands of the previous frame.
+# Returns the states, stuck and circling flags and the decisions that were made.
+def load_decisions(log_path):
+    records = []
+    with open(log_path) as log_file:
+        for line in log_file:
+            record = json.loads(line)
+            if record.get('kind') == 'frame':
+                records.append(record)
+    pairs = [(previous, current) for previous, current in zip(records, records[1:])
+             if current['frame'] == previous['frame'] + 1 and current.get('sid') == previous.get('sid')
+             and previous['mode'] == Mode.TRAVEL and current['rock_size'] is not None]
+    states = {field: [] for field in state_fields}
+    reference = {'throttle': [], 'brake': [], 'steer': [], 'next_mode': []}
+    for previous, current in pairs:
+        for field in state_fields:
+            source = previous if field in ('throttle', 'brake', 'steer') else current
+            states[field].append(source[field] if source[field] is not None else 0)
+        for field in ('throttle', 'brake', 'steer'):
+            reference[field].append(current[field])
+        reference['next_mode'].append(mode_index[Mode(current['mode'])])
+    states = {field: np.array(values, dtype=np.float64) for field, values in states.items()}
+    reference = {field: np.array(values) for field, values in reference.items()}
+    stuck = reference['next_mode'] == mode_index[Mode.UNSTUCK_ON_TRAVEL]
+    circling = reference['next_mode'] == mode_index[Mode.BREAK_LOOP]
+    return states, stuck, circling, reference
+
+# Values of a --sweep option: name=start:stop:step (stop excluded) or name=value,value,...
+def parse_sweep(option):
+    name, values = option.split('=')
+    if name not in parameter_names:
+        raise argparse.ArgumentTypeError('{} is not one of {}'.format(name, ', '.join(parameter_names)))
+    if ':' in values:
+        start, stop, step = (float(value) for value in values.split(':'))
+        return name, list(np.arange(start, stop, step))
+    return name, [float(value) for value in values.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate the travel decisions recorded in a telemetry log '
+                                                 'for many sets of decision parameters')
+    parser.add_argument(
+        'log',
+        type=str,
+        help='Telemetry log recorded with --log-verbosity 2 and --log-sample 1.'
+    )
+    parser.add_argument(
+        '--sweep',
+        type=parse_sweep,
+        action='append',
+        default=[],
+        help='Values of a parameter: name=start:stop:step or name=value,value,... (can be repeated).'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Number of threads evaluating the parameter sets.'
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='../output/decision_sweep.json',
+        help='Path of the JSON file where the statistics of every parameter set are written.'
+    )
+    args = parser.parse_args()
+
+    # The default parameters are the ones of a new rover
+    defaults = {name: decision_parameters[name] for name in parameter_names}
+    states, stuck, circling, reference = load_decisions(args.log)
+    if len(states['vel']) == 0:
+        raise SystemExit('No travel decisions in {}'.format(args.log))
+    parameters = parameter_grid(defaults, dict(args.sweep))
+
+    start = time.perf_counter()
+    statistics = sweep(states, parameters, stuck, circling, reference, args.workers)
+    elapsed = time.perf_counter() - start
+    set_count = len(parameters['max_vel'])
+    print('{} parameter sets x {} decisions in {:.3f} s ({:.0f} parameter sets per second)'.format(
+          set_count, len(states['vel']), elapsed, set_count / elapsed))
+    default_statistics = decision_statistics(states, {name: [value] for name, value in defaults.items()},
+                                             stuck, circling, reference)
+    print('Default parameters reproduce {:.1f}% of the recorded decisions'.format(
+          100 * default_statistics['agreement'][0]))
+
+    results = [dict({name: float(parameters[name][index]) for name in parameter_names},
+                    **{name: round(float(values[index]), 4) for name, values in statistics.items()})
+               for index in range(set_count)]
+    with open(args.output, 'w') as output_file:
+        json.dump({'decisions': len(states['vel']), 'defaults': defaults, 'results': results}, output_file, indent=2)
+    print('Results written to {}'.format(args.output))
@@ -9,139 +9,187 @@ import numpy as np
 import socketio
 import eventlet
 import eventlet.wsgi
+import eventlet.semaphore
+from eventlet import tpool
 from PIL import Image
 from flask import Flask
 from io import BytesIO, StringIO
 import json
 import pickle
-import matplotlib.image as mpimg
 import time
 
 # Import functions for perception and decision making
 from perception import perception_step
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from supporting_functions import update_rover
+from inset_renderer import InsetRenderer
+from perception_pipeline import PerceptionPipeline
+from profiler import profiler
+from telemetry_logger import logger, SUMMARY
+from run_recorder import RunRecorder
+from state_snapshot import SnapshotBuffer
+from rover_state import RoverState
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
 
-# Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        self.img = None # Current camera image
-        self.pos = None # Current position (x, y)
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.vel = None # Current velocity
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = None # Angles of navigable terrain pixels
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.mode = 'start' # Current mode (can be forward or stop)
-        self.throttle_set = 0.2 # Throttle setting when accelerating
-        self.brake_set = 10 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.stop_forward = 50 # Threshold to initiate stopping
-        self.go_forward = 500 # Threshold to go forward again
-        self.max_vel = 2 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float) 
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_found = 0 # To count the number of samples found
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-                
-        # Add-on attributes
-        self.starting_pos = None
-        
-        self.front_wall_distance = 0
-        self.left_wall_distance  = 0
-        self.right_wall_distance = 0
-        
-        self.rock_size = None
-        self.rock_angle = None
-        self.rock_pos = None 
-    
-        # to keep track of the targetted rock in case it is out of sight.
-        self.target_rock_pos = None
-                
-        # to detect if it gets stuck
-        self.marked_pos = None
-        self.unmoveable_counter = 0
+# Everything that belongs to the connection with one simulator: its own rover,
+# FPS counters and inset renderer, so one process can drive several rovers
+class RoverSession():
+    def __init__(self, sid):
+        self.sid = sid
+        self.Rover = RoverState(map_resolution=args.map_resolution, tiled_map=args.tiled_map,
+                                frontier_exploration=args.frontier_exploration,
+                                perception_range=args.perception_range or None)
+        # Renders the inset images of this rover in the background
+        self.inset_renderer = InsetRenderer(args.inset_rate)
+        # Perception runs in its own thread when pipelined (and renders the insets of its results)
+        self.pipeline = None
+        if args.pipelined:
+            self.pipeline = PerceptionPipeline(self.Rover, self.inset_renderer.submit, args.pipeline_queue)
+        # State of the rover after each of the last frames, written when the session ends or fails
+        self.snapshots = None
+        if args.snapshots != '':
+            self.snapshots = SnapshotBuffer()
+        # Camera images and rover states of the run, written to a new file in the background
+        # (run_000.rover, run_001.rover, ... in the image folder, one per session)
+        self.recorder = None
+        if args.image_folder != '' and args.record_format == 'rover':
+            os.makedirs(args.image_folder, exist_ok=True)
+            self.recorder = RunRecorder(new_recording_path(args.image_folder))
+        # The telemetry of a session is processed one message at a time, in order
+        self.lock = eventlet.semaphore.Semaphore()
+        # Variables to track frames per second (FPS)
+        self.frame_counter = 0
+        self.second_counter = time.time()
+        self.fps = None
+
+    # Stop the background threads of the session (the frames still waiting are recorded)
+    def close(self):
+        if self.pipeline is not None:
+            self.pipeline.close()
+        self.inset_renderer.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.write_snapshots()
 
-        # to detect if it is circling
-        self.continuous_steer_counter = 0
-        self.previous_steer = None
+    # Write the states of the last frames to <sid>.snapshots in the snapshots folder
+    def write_snapshots(self):
+        if self.snapshots is None or self.snapshots.count == 0:
+            return
+        os.makedirs(args.snapshots, exist_ok=True)
+        with open(os.path.join(args.snapshots, '{}.snapshots'.format(self.sid)), 'wb') as output_file:
+            self.snapshots.write(output_file)
 
-        # to keep track of how long it is reversing and turning
-        self.spin_back_counter = 0
+# Path of a recording file that doesn't exist yet in a folder
+def new_recording_path(folder):
+    number = 0
+    while os.path.exists(os.path.join(folder, 'run_{:03d}.rover'.format(number))):
+        number += 1
+    return os.path.join(folder, 'run_{:03d}.rover'.format(number))
 
-        self.status = ''
+# Sessions of the connected simulators, by socketio sid
+sessions = {}
 
+def get_session(sid):
+    if sid not in sessions:
+        sessions[sid] = RoverSession(sid)
+    return sessions[sid]
 
-# Initialize our rover 
-Rover = RoverState()
+# Run a CPU bound function in the worker pool (native threads), so the eventlet hub
+# keeps serving the other simulators meanwhile, or directly when there are no workers
+def run_in_pool(function, *arguments):
+    if args.workers > 0:
+        return tpool.execute(function, *arguments)
+    return function(*arguments)
 
-# Variables to track frames per second (FPS)
-# Intitialize frame counter
-frame_counter = 0
-# Initalize second counter
-second_counter = time.time()
-fps = None
+# CPU bound part of the telemetry loop: update the rover with the telemetry and run
+# the perception and decision steps. Returns the raw JPEG camera image for saving.
+def process_telemetry(session, data):
+    # Initialize / update Rover with current telemetry
+    with profiler.stage('update_rover'):
+        session.Rover, jpeg = update_rover(session.Rover, data)
+    Rover = session.Rover
+    if profiler.enabled:
+        profiler.record('update_rover.decode', Rover.telemetry_decoder.decode_time)
+
+    if np.isfinite(Rover.vel):
+
+        # Execute the perception and decision steps to update the Rover's state
+        perceived = True
+        if session.pipeline is not None:
+            # Hand the frame over to the perception thread and use its most recent result
+            with profiler.stage('perception_submit'):
+                session.pipeline.submit(Rover)
+                perceived = session.pipeline.apply_latest(Rover)
+        else:
+            with profiler.stage('perception_step'):
+                session.Rover = Rover = perception_step(Rover)
+        transitions = Rover.mode_history.count
+        # Without any perception result yet, the rover keeps its previous commands
+        if perceived:
+            with profiler.stage('decision_step'):
+                session.Rover = Rover = decision_step(Rover)
+        for transition_time, previous_mode, mode in Rover.mode_history.transitions(transitions):
+            logger.log('transition', SUMMARY, sid=session.sid, total_time=transition_time,
+                       previous_mode=previous_mode, mode=mode)
+        # Record the rover state in the background (if verbose enough)
+        logger.frame(Rover, sid=session.sid)
+        if session.snapshots is not None:
+            with profiler.stage('snapshot'):
+                session.snapshots.save(Rover)
+
+        # Queue output images for rendering
+        # (they are rendered by create_output_images in the background)
+        if session.pipeline is None:
+            with profiler.stage('inset_submit'):
+                session.inset_renderer.submit(Rover)
+    return jpeg
 
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
+    session = get_session(sid)
+    with session.lock:
+        handle_telemetry(session, data)
 
-    global frame_counter, second_counter, fps
-    frame_counter+=1
+def handle_telemetry(session, data):
+    sid = session.sid
+    session.frame_counter+=1
     # Do a rough calculation of frames per second (FPS)
-    if (time.time() - second_counter) > 1:
-        fps = frame_counter
-        frame_counter = 0
-        second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+    if (time.time() - session.second_counter) > 1:
+        session.fps = session.frame_counter
+        session.frame_counter = 0
+        session.second_counter = time.time()
+        Rover = session.Rover
+        decode_ms, parse_ms = Rover.telemetry_decoder.average_times(reset=True)
+        pipeline_fields = {}
+        if session.pipeline is not None:
+            pipeline_fields = {'dropped_frames': session.pipeline.dropped,
+                               'frames_behind': session.pipeline.frames_behind}
+        if session.recorder is not None:
+            pipeline_fields['unrecorded_frames'] = session.recorder.dropped
+        logger.summary(sid=sid, fps=session.fps, decode_ms=round(decode_ms, 2), parse_ms=round(parse_ms, 2),
+                       mode=Rover.mode, total_time=Rover.total_time, samples_found=Rover.samples_found,
+                       dropped_records=logger.dropped, **pipeline_fields)
+        # Export the latency statistics of each stage once per second
+        if args.profile != '':
+            profiler.export(args.profile)
 
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
+        try:
+            jpeg = run_in_pool(process_telemetry, session, data)
+        except Exception:
+            # Keep the states that led to the failure
+            session.write_snapshots()
+            raise
+        Rover = session.Rover
 
         if np.isfinite(Rover.vel):
-
-            # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
-
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
+            # Get the most recent inset images to send to server
+            out_image_string1, out_image_string2 = session.inset_renderer.latest()
 
             # The action step!  Send commands to the rover!
  
@@ -151,42 +199,59 @@ def telemetry(sid, data):
 
             # If in a state where want to pickup a rock send pickup command
             if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
+                send_pickup(sid)
                 # Reset Rover flags
                 Rover.send_pickup = False
             else:
                 # Send commands to the rover!
                 commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
+                with profiler.stage('send_control'):
+                    send_control(sid, commands, out_image_string1, out_image_string2)
 
         # In case of invalid telemetry, send null commands
         else:
 
             # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
+            send_control(sid, (0, 0, 0), '', '')
 
         # If you want to save camera images from autonomous driving specify a path
         # Example: $ python drive_rover.py image_folder_path
         # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
+        if session.recorder is not None:
+            with profiler.stage('record'):
+                session.recorder.record(session.Rover, jpeg)
+        elif args.image_folder != '':
             timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
             image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+            # Images of the other rovers go to their own folder
+            if len(sessions) > 1:
+                image_filename = os.path.join(args.image_folder, str(sid), timestamp)
+                os.makedirs(os.path.dirname(image_filename), exist_ok=True)
+            with open('{}.jpg'.format(image_filename), 'wb') as image_file:
+                image_file.write(jpeg)
 
     else:
-        sio.emit('manual', data={}, skip_sid=True)
+        sio.emit('manual', data={}, room=sid)
 
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    get_session(sid)
+    send_control(sid, (0, 0, 0), '', '')
     sample_data = {}
     sio.emit(
         "get_samples",
         sample_data,
-        skip_sid=True)
+        room=sid)
+
+@sio.on('disconnect')
+def disconnect(sid):
+    print("disconnect ", sid)
+    session = sessions.pop(sid, None)
+    if session is not None:
+        session.close()
 
-def send_control(commands, image_string1, image_string2):
+def send_control(sid, commands, image_string1, image_string2):
     # Define commands to be sent to the rover
     data={
         'throttle': commands[0].__str__(),
@@ -195,22 +260,23 @@ def send_control(commands, image_string1, image_string2):
         'inset_image1': image_string1,
         'inset_image2': image_string2,
         }
-    # Send commands via socketIO server
+    # Send commands via socketIO server, to the simulator of this session only
     sio.emit(
         "data",
         data,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command 
-def send_pickup():
+def send_pickup(sid):
     print("Picking up")
     pickup = {}
     sio.emit(
         "pickup",
         pickup,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
-if __name__ == '__main__':
+# Command line options of the server (also used by replay_rover.py)
+def build_parser():
     parser = argparse.ArgumentParser(description='Remote Driving')
     parser.add_argument(
         'image_folder',
@@ -219,7 +285,124 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        '--record-format',
+        type=str,
+        choices=['rover', 'jpeg'],
+        default='rover',
+        help='rover: camera images and rover states in one file per rover (see run_recorder.py), '
+             'jpeg: one JPEG file per frame.'
+    )
+    parser.add_argument(
+        '--snapshots',
+        type=str,
+        default='',
+        help='Folder where the states of the last frames of a rover are written (<sid>.snapshots) when it '
+             'disconnects or its telemetry can\'t be handled (see state_snapshot.py and replay_rover.py --resume).'
+    )
+    parser.add_argument(
+        '--inset-rate',
+        type=float,
+        default=5,
+        help='Maximum number of inset image renders per second (0 to render every frame).'
+    )
+    parser.add_argument(
+        '--map-resolution',
+        type=float,
+        default=1,
+        help='Resolution of the worldmap in cells per meter.'
+    )
+    parser.add_argument(
+        '--tiled-map',
+        action='store_true',
+        help='Use a worldmap that grows with the explored area, for terrains larger than the ground truth map '
+             '(the way home is not planned over it).'
+    )
+    parser.add_argument(
+        '--frontier-exploration',
+        action='store_true',
+        help='Experimental: explore by driving to the frontier of the mapped area instead of following the '
+             'left wall. It maps less of the world than following the wall for now.'
+    )
+    parser.add_argument(
+        '--perception-range',
+        type=float,
+        default=0,
+        help='Only map and measure the ground closer than this many meters in the camera image (0 for no limit).'
+    )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default='',
+        help='Path of a JSON file where the latency percentiles of each stage are written every second.'
+    )
+    parser.add_argument(
+        '--profile-port',
+        type=int,
+        default=0,
+        help='Serve the latency percentiles of each stage on http://localhost:<port>/.'
+    )
+    parser.add_argument(
+        '--log',
+        type=str,
+        default='',
+        help='Path of a JSON lines file where the telemetry summaries and rover states are recorded.'
+    )
+    parser.add_argument(
+        '--log-verbosity',
+        type=int,
+        default=1,
+        help='0: nothing, 1: once per second summaries, 2: summaries and the rover state of every frame.'
+    )
+    parser.add_argument(
+        '--log-sample',
+        type=int,
+        default=1,
+        help='Record the rover state of 1 frame out of this many.'
+    )
+    parser.add_argument(
+        '--pipelined',
+        action='store_true',
+        help='Run perception in its own thread: commands use the most recent perception result '
+             'instead of waiting for the perception of the current frame.'
+    )
+    parser.add_argument(
+        '--pipeline-queue',
+        type=int,
+        default=1,
+        help='Number of frames waiting for perception in pipelined mode (older frames are dropped).'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Number of worker threads running the perception and decision steps of the connected rovers '
+             '(0 to run them in the server thread).'
+    )
+    return parser
+
+# Set up the rover and the telemetry loop from the command line options
+def configure(options):
+    global args
+    args = options
+    if args.tiled_map and args.frontier_exploration:
+        raise SystemExit('--frontier-exploration plans paths over the fixed size worldmap, '
+                         'it can\'t be used with --tiled-map')
+    logger.configure(args.log, args.log_verbosity, args.log_sample)
+    if args.workers > 0:
+        tpool.set_num_threads(args.workers)
+    if args.profile != '' or args.profile_port:
+        profiler.enabled = True
+        if args.profile_port:
+            profiler.serve(args.profile_port)
+    # Rovers are created when their simulator connects
+    for session in sessions.values():
+        session.close()
+    sessions.clear()
+
+
+if __name__ == '__main__':
+    configure(build_parser().parse_args())
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
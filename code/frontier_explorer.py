@@ -0,0 +1,103 @@
+import numpy as np
+import cv2
+from scipy.spatial import cKDTree
+from path_planner import UNKNOWN, FREE
+
+# Frontier clusters smaller than this (cells) are ignored, they are mostly classification noise
+MIN_CLUSTER_SIZE = 5
+# Number of closest frontier clusters considered when choosing the next goal
+CANDIDATES = 8
+# A goal is reached when the rover gets this close to it (meters)
+GOAL_REACHED = 2
+# Goals the rover couldn't find a way to are avoided within this radius (meters)
+UNREACHABLE_RADIUS = 3
+# Frontier cells are searched this far (cells) around the goal to see if it is still worth going to
+GOAL_FRONTIER_RADIUS = 2
+
+# Picks exploration goals on the frontier of the worldmap: known navigable cells that are next
+# to cells that haven't been seen yet. The frontier is kept up to date from the cost map of the
+# path planner, only around the cells whose kind changed. When a new goal is needed, frontier
+# cells are clustered and the best cluster close to the rover is found with a k-d tree.
+# The frontier is guarded by the lock of the path planner, like the cost map it comes from.
+# Experimental (off unless --frontier-exploration): in the replays on the ground truth map it
+# still maps about 10 points less of the world than following the left wall.
+class FrontierExplorer():
+    def __init__(self, path_planner):
+        self.path_planner = path_planner
+        self.resolution = path_planner.resolution
+        self.frontier = np.zeros(path_planner.kinds.shape, dtype=bool)
+        self.goal = None # goal cell (x, y)
+        self.unreachable = [] # goal cells that couldn't be reached
+
+    # Update the frontier in the area (rows, columns slices) where the kinds of cells changed
+    def update(self, window):
+        with self.path_planner.lock:
+            if window is None:
+                return
+            kinds = self.path_planner.kinds
+            size = kinds.shape[0]
+            rows, columns = window
+            # The frontier state of a cell depends on its neighbors: one more cell on each side
+            top, bottom = max(rows.start - 1, 0), min(rows.stop + 1, size)
+            left, right = max(columns.start - 1, 0), min(columns.stop + 1, size)
+            outer_top, outer_left = max(top - 1, 0), max(left - 1, 0)
+            block = kinds[outer_top:bottom + 1, outer_left:right + 1]
+            unknown = cv2.dilate((block == UNKNOWN).astype(np.uint8),
+                                 cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))) > 0
+            frontier = (block == FREE) & unknown
+            self.frontier[top:bottom, left:right] = frontier[top - outer_top:bottom - outer_top,
+                                                             left - outer_left:right - outer_left]
+
+    def is_goal_valid(self, rover_cell):
+        if self.goal is None:
+            return False
+        if np.hypot(self.goal[0] - rover_cell[0], self.goal[1] - rover_cell[1]) < GOAL_REACHED * self.resolution:
+            return False
+        x, y = self.goal
+        r = GOAL_FRONTIER_RADIUS
+        return self.frontier[max(y - r, 0):y + r + 1, max(x - r, 0):x + r + 1].any()
+
+    # Choose the frontier cluster with the most frontier per distance among the closest ones
+    def choose_goal(self, rover_cell):
+        self.goal = None
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(self.frontier.astype(np.uint8),
+                                                                           connectivity=8)
+        clusters = np.flatnonzero(stats[1:, cv2.CC_STAT_AREA] >= MIN_CLUSTER_SIZE) + 1
+        if len(clusters) == 0:
+            return
+        # The centroid of a cluster may not be on the frontier: go to the cell of the cluster closest to it instead
+        ypos, xpos = labels.nonzero()
+        cell_labels = labels[ypos, xpos]
+        kept = np.isin(cell_labels, clusters)
+        xpos, ypos, cell_labels = xpos[kept], ypos[kept], cell_labels[kept]
+        centroid_dists = (xpos - centroids[cell_labels, 0])**2 + (ypos - centroids[cell_labels, 1])**2
+        order = np.lexsort((centroid_dists, cell_labels))
+        _, first = np.unique(cell_labels[order], return_index=True) # closest cell of each cluster, by label
+        closest = order[first]
+        goals = np.stack((xpos[closest], ypos[closest]), axis=1)
+        sizes = stats[clusters, cv2.CC_STAT_AREA]
+        if self.unreachable:
+            far_enough = cKDTree(self.unreachable).query(goals)[0] > UNREACHABLE_RADIUS * self.resolution
+            goals, sizes = goals[far_enough], sizes[far_enough]
+            if len(goals) == 0:
+                return
+        dists, candidates = cKDTree(goals).query(rover_cell, k=min(CANDIDATES, len(goals)))
+        dists, candidates = np.atleast_1d(dists), np.atleast_1d(candidates)
+        best = candidates[np.argmax(sizes[candidates] / (dists + 1))]
+        self.goal = tuple(goals[best])
+
+    # Next point (meters) to steer toward to explore, or None when there is nowhere to go
+    # (or no path yet to the goal)
+    def next_waypoint(self, pos):
+        with self.path_planner.lock:
+            rover_cell = self.path_planner.to_cell(pos)
+            if not self.is_goal_valid(rover_cell):
+                self.choose_goal(rover_cell)
+                if self.goal is None:
+                    return None
+            goal_pos = ((self.goal[0] + 0.5) / self.resolution, (self.goal[1] + 0.5) / self.resolution)
+            waypoint = self.path_planner.next_waypoint(pos, goal_pos)
+            if waypoint is None and self.path_planner.unreachable:
+                self.unreachable.append(self.goal)
+                self.goal = None
+            return waypoint
@@ -0,0 +1,87 @@
+import copy
+import threading
+import time
+from supporting_functions import create_output_images
+from profiler import profiler
+
+# Copy of the rover state fields that create_output_images reads,
+# so the rover can keep updating while the copy is being rendered
+class OutputSnapshot():
+    def __init__(self, Rover):
+        self.worldmap = Rover.worldmap.copy()
+        self.ground_truth = Rover.ground_truth
+        self.vision_labels = Rover.vision_labels.copy()
+        self.samples_pos = Rover.samples_pos
+        self.samples_found = Rover.samples_found
+        self.rock_registry = Rover.rock_registry.copy()
+        self.total_time = Rover.total_time
+        # Only the counts are read when rendering, so a shallow copy is enough
+        self.map_statistics = copy.copy(Rover.map_statistics)
+
+# Renders the inset images (worldmap and vision image) in a background thread at a limited rate.
+# The control loop never waits for rendering: it always sends the most recent encoded images.
+class InsetRenderer():
+    def __init__(self, rate=5):
+        self.set_rate(rate)
+        self.images = ('', '') # Most recent encoded (worldmap, vision) images
+        self.pending = None # Snapshot waiting to be rendered
+        self.last_submit_time = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.error = None # Exception that stopped the renderer
+        self.stopped = False
+
+    # Maximum number of renders per second (0 or less to render every submitted frame)
+    def set_rate(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+
+    # Queue the current rover state for rendering if the last render is old enough.
+    # A snapshot that hasn't been rendered yet is replaced by the newer one.
+    # Nothing is rendered anymore once a render failed.
+    def submit(self, Rover):
+        if self.error is not None:
+            return
+        now = time.time()
+        if now - self.last_submit_time < self.interval:
+            return
+        self.last_submit_time = now
+        snapshot = OutputSnapshot(Rover)
+        with self.condition:
+            if self.stopped:
+                return
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.pending = snapshot
+            self.condition.notify()
+
+    # Stop the render thread (the snapshot waiting to be rendered, if any, is dropped)
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            thread = self.thread
+            self.condition.notify()
+        if thread is not None:
+            thread.join()
+
+    # Most recent encoded images, '' until the first render is done
+    def latest(self):
+        return self.images
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                snapshot = self.pending
+                self.pending = None
+            try:
+                with profiler.stage('create_output_images'):
+                    self.images = create_output_images(snapshot)
+            except Exception as error:
+                # Stop rendering: the error is reported once (by the thread), the previous images
+                # keep being sent
+                self.error = error
+                raise
@@ -0,0 +1,52 @@
+import numpy as np
+from occupancy_grid import NAVIGABLE_CHANNEL
+
+# Keeps the "Mapped" and "Fidelity" statistics of the worldmap up to date incrementally.
+# A map cell counts as navigable when its navigable (blue) channel is positive,
+# just like the navigable pixels of the plotted map in create_output_images.
+class MapStatistics():
+    def __init__(self, ground_truth):
+        self.truth = ground_truth[:,:,1] > 0
+        # Ground truth never changes, so its pixel count is only calculated once
+        self.tot_map_pix = np.count_nonzero(self.truth)
+        # Navigable state of every cell as of the last update
+        self.navigable = np.zeros(self.truth.shape, dtype=bool)
+        self.tot_nav_pix = 0 # Total number of navigable cells
+        self.good_nav_pix = 0 # Navigable cells that are ground truth pixels
+        self.bad_nav_pix = 0 # Navigable cells that are not ground truth pixels
+
+    # Update the counts for the cells (x, y) of the worldmap grid that were just written to.
+    # Cost is proportional to the number of cells, not to the map size.
+    # Cells outside of the ground truth map are not counted.
+    def update(self, grid, x_world, y_world):
+        inside = (x_world >= 0) & (x_world < self.truth.shape[1]) \
+               & (y_world >= 0) & (y_world < self.truth.shape[0])
+        # Mark the written cells, which is cheaper than sorting them to remove duplicates
+        written = np.zeros(self.truth.size, dtype=bool)
+        written[np.ravel_multi_index((y_world[inside], x_world[inside]), self.truth.shape)] = True
+        cells = np.flatnonzero(written)
+        if len(cells) == 0:
+            return
+        ypos, xpos = np.unravel_index(cells, self.truth.shape)
+        was_navigable = self.navigable[ypos, xpos]
+        is_navigable = grid.values(xpos, ypos, NAVIGABLE_CHANNEL) > 0
+        changed = was_navigable != is_navigable
+        if not changed.any():
+            return
+        # +1 for cells that became navigable, -1 for cells that are not navigable anymore
+        delta = np.where(is_navigable[changed], 1, -1)
+        truth = self.truth[ypos[changed], xpos[changed]]
+        self.tot_nav_pix += int(delta.sum())
+        self.good_nav_pix += int(delta[truth].sum())
+        self.bad_nav_pix += int(delta[~truth].sum())
+        self.navigable[ypos[changed], xpos[changed]] = is_navigable[changed]
+
+    # Percentage of ground truth map that has been successfully found
+    def perc_mapped(self):
+        return round(100 * self.good_nav_pix / self.tot_map_pix, 1)
+
+    # Number of good map pixel detections divided by total pixels found to be navigable terrain
+    def fidelity(self):
+        if self.tot_nav_pix > 0:
+            return round(100 * self.good_nav_pix / self.tot_nav_pix, 1)
+        return 0
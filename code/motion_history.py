@@ -0,0 +1,129 @@
+import numpy as np
+
+# Seconds of records kept, longer than the windows queried by decision.py (CIRCLING_TIME)
+HISTORY_SECONDS = 30
+# Number of frames the history starts with (more than a minute at 25 FPS)
+HISTORY_SIZE = 2048
+
+# Pose and commands of the rover over the last frames, in arrays used as a ring buffer, so recording
+# a frame doesn't allocate and the queries over a time window are array operations whose cost
+# doesn't depend on how long the rover has been running. The arrays are doubled when the frame
+# rate is too high for them to hold the last seconds (then the queries still cover the same time
+# whatever the frame rate).
+class MotionHistory():
+    fields = ('time', 'x', 'y', 'yaw', 'vel', 'throttle', 'steer')
+
+    def __init__(self, seconds=HISTORY_SECONDS, size=HISTORY_SIZE):
+        self.seconds = seconds
+        self.size = size
+        self.time = np.full(size, -np.inf) # -inf for the records that were never written
+        self.x = np.zeros(size)
+        self.y = np.zeros(size)
+        self.yaw = np.zeros(size)
+        self.vel = np.zeros(size)
+        self.throttle = np.zeros(size)
+        self.steer = np.zeros(size)
+        self.index = 0 # where the next record goes
+        self.since = -np.inf # records older than this are ignored by the queries (see reset)
+
+    def record(self, Rover):
+        # The record about to be overwritten is still within the seconds kept
+        if self.time[self.index] > Rover.total_time - self.seconds:
+            self.grow()
+        i = self.index
+        self.time[i] = Rover.total_time
+        self.x[i], self.y[i] = Rover.pos[0], Rover.pos[1]
+        self.yaw[i] = Rover.yaw
+        self.vel[i] = Rover.vel
+        self.throttle[i] = Rover.throttle
+        self.steer[i] = Rover.steer
+        self.index = (i + 1) % self.size
+
+    # Double the size of the arrays, the records are moved to the start, oldest first
+    def grow(self):
+        order = (np.arange(self.size) + self.index) % self.size
+        for field in self.fields:
+            values = np.full(self.size * 2, -np.inf if field == 'time' else 0.0)
+            values[:self.size] = getattr(self, field)[order]
+            setattr(self, field, values)
+        self.index = self.size
+        self.size *= 2
+
+    def latest_time(self):
+        return self.time[self.index - 1]
+
+    # Forget the records up to now, so a detection made from them doesn't fire again
+    def reset(self):
+        self.since = self.latest_time()
+
+    # Indices of the records of the last seconds, oldest first. Returns None if the history doesn't
+    # go back that far, unless partial is True (then the records since the last reset are returned).
+    def window(self, seconds, partial=False):
+        start = self.latest_time() - seconds
+        order = (np.arange(self.size) + self.index) % self.size
+        times = self.time[order] # increasing, -inf first
+        first = max(np.searchsorted(times, max(start, self.since), side='left'),
+                    np.searchsorted(times, -np.inf, side='right')) # skip the records never written
+        covered = first > 0 and np.isfinite(times[first - 1]) and self.since <= start
+        if not covered and not partial:
+            return None
+        return order[first:]
+
+    # Largest distance (meters) between a position and the positions of a window
+    def max_distance(self, window, pos):
+        if len(window) == 0:
+            return 0
+        return np.hypot(self.x[window] - pos[0], self.y[window] - pos[1]).max()
+
+    # Total yaw change (degrees) over a window, positive when turning left
+    def total_turn(self, window):
+        turns = (np.diff(self.yaw[window]) + 180) % 360 - 180
+        return turns.sum()
+
+
+# Check that the decisions made from the history don't depend on the frame rate: the same trajectory
+# (driving, stuck against a rock, circling, driving again) sampled at 30 and 200 FPS must be found
+# stuck and circling at the same times.
+# Example: $ python motion_history.py
+if __name__ == '__main__':
+    from decision import is_stuck, is_circling
+
+    class TrajectoryRover():
+        def __init__(self):
+            self.motion_history = MotionHistory()
+            self.spin_back_until = None
+
+        # Pose and commands at time t (seconds)
+        def move_to(self, t):
+            self.total_time = t
+            self.throttle, self.vel = 0.2, 1.0
+            if t < 10: # straight ahead
+                self.pos, self.yaw, self.steer = [t, 0.0], 0.0, 0
+            elif t < 16: # stuck
+                self.pos, self.yaw, self.steer, self.vel = [10.0, 0.0], 0.0, 0, 0.0
+            elif t < 40: # circles of 3 m at 20 degrees per second
+                angle = np.radians(20 * (t - 16))
+                self.pos = [10 + 3 * np.sin(angle), 3 - 3 * np.cos(angle)]
+                self.yaw, self.steer = np.degrees(angle) % 360, 10
+            else: # straight ahead again
+                self.pos, self.yaw, self.steer = [10 + (t - 40), 0.0], 0.0, 0
+
+    def decision_times(frame_rate, duration=60):
+        Rover = TrajectoryRover()
+        times = {'stuck': [], 'circling': []}
+        for frame in range(int(duration * frame_rate)):
+            Rover.move_to(frame / frame_rate)
+            Rover.motion_history.record(Rover)
+            for name, decision in (('stuck', is_stuck), ('circling', is_circling)):
+                if decision(Rover):
+                    times[name].append(Rover.total_time)
+        return times
+
+    slow, fast = decision_times(30), decision_times(200)
+    for name in slow:
+        print('{}: {} at 30 FPS, {} at 200 FPS'.format(name, np.round(slow[name], 2), np.round(fast[name], 2)))
+        # The decisions can only be made on a frame: up to a frame apart at 30 FPS
+        if len(slow[name]) != len(fast[name]) or \
+           np.any(np.abs(np.subtract(slow[name], fast[name])) > 1.5 / 30):
+            raise SystemExit('The {} decisions depend on the frame rate'.format(name))
+    print('Same decisions at 30 and 200 FPS')
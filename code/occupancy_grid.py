@@ -0,0 +1,199 @@
+import numpy as np
+import cv2
+
+# Channels of the grid, in the same order as the color channels of the displayed worldmap
+OBSTACLE_CHANNEL  = 0 # red
+ROCK_CHANNEL      = 1 # green
+NAVIGABLE_CHANNEL = 2 # blue
+
+# Size of the tiles of TiledOccupancyGrid (cells), a power of 2 so tiles can be halved for the overviews
+TILE_SIZE = 64
+
+# Evidence values are clamped to +/- this limit so they always fit in an int16. A cell seen
+# many times does reach it (a square meter is 100 pixels of the top-down view on every frame),
+# and from then on it takes as much contrary evidence to change its kind.
+EVIDENCE_LIMIT = 10000
+
+# Resample an image of the world at 1 pixel per meter (like the ground truth map) to size x size cells
+def resample_to_grid(image, size):
+    if image.shape[0] == size and image.shape[1] == size:
+        return image
+    return cv2.resize(image, (size, size), interpolation=cv2.INTER_NEAREST)
+
+# Extract the part of a world image (indexed by cell) that a display map covers,
+# given the cell of its first pixel and the number of cells per display pixel
+def crop_to_display(image, origin_x, origin_y, step, shape):
+    if origin_x == 0 and origin_y == 0 and step == 1 and image.shape[:2] == shape[:2]:
+        return image
+    view = np.zeros(shape[:2] + image.shape[2:], dtype=image.dtype)
+    ypos = origin_y + step * np.arange(shape[0])
+    xpos = origin_x + step * np.arange(shape[1])
+    inside_y = (ypos >= 0) & (ypos < image.shape[0])
+    inside_x = (xpos >= 0) & (xpos < image.shape[1])
+    view[np.ix_(inside_y, inside_x)] = image[np.ix_(ypos[inside_y], xpos[inside_x])]
+    return view
+
+# Worldmap of the rover: for each cell and each kind of object (obstacle, rock, navigable),
+# the accumulated evidence that the cell is that kind of object: the weighted count of the
+# pixels seen there (see perception.map_increments), a positive value meaning more for than against.
+class OccupancyGrid():
+    def __init__(self, world_size=200, resolution=1, limit=EVIDENCE_LIMIT):
+        self.world_size = world_size # Size of the world (meters)
+        self.resolution = resolution # Number of cells per meter
+        self.size = int(round(world_size * resolution)) # Size of the grid (cells)
+        self.limit = limit
+        self.evidence = np.zeros((self.size, self.size, 3), dtype=np.int16)
+
+    @property
+    def shape(self):
+        return self.evidence.shape
+
+    def copy(self):
+        grid = OccupancyGrid(self.world_size, self.resolution, self.limit)
+        grid.evidence[:] = self.evidence
+        return grid
+
+    # Resample an image of the world at 1 pixel per meter (like the ground truth map) to the grid shape
+    def resample(self, image):
+        return resample_to_grid(image, self.size)
+
+    # Convert world positions (in cells, not rounded) to cell indices, clipped to the grid
+    def to_cells(self, x_world, y_world):
+        x_cells = np.clip(np.int_(x_world), 0, self.size - 1)
+        y_cells = np.clip(np.int_(y_world), 0, self.size - 1)
+        return x_cells, y_cells
+
+    # Evidence of a channel at the given cells
+    def values(self, x_cells, y_cells, channel):
+        return self.evidence[y_cells, x_cells, channel]
+
+    # Evidence image to display and where it is in the world:
+    # (image, x and y cell of the first pixel, number of cells per pixel)
+    def display_map(self, max_size):
+        return self.evidence, 0, 0, 1
+
+    # Add one observation per (x, y) cell: increments[channel] is added to each channel.
+    # A cell observed several times accumulates all of its observations. Values are clamped
+    # after each update, so once a cell reaches the limit the result depends on the order of
+    # the updates (perception_step makes them in the same order on every frame, see
+    # process_dataset.update_worldmap).
+    def update(self, x_cells, y_cells, increments):
+        if len(x_cells) == 0:
+            return
+        counts = np.bincount(np.ravel_multi_index((y_cells, x_cells), (self.size, self.size)),
+                             minlength=self.size * self.size)
+        cells = np.flatnonzero(counts)
+        counts = counts[cells]
+        ypos, xpos = np.unravel_index(cells, (self.size, self.size))
+        for channel in range(3):
+            values = self.evidence[ypos, xpos, channel] + counts * increments[channel]
+            self.evidence[ypos, xpos, channel] = np.clip(values, -self.limit, self.limit)
+
+
+# Same as OccupancyGrid, but for worlds of any size: the grid is split into tiles that are
+# only allocated once something has been observed in them, so memory grows with the explored
+# area. Cells are not clipped and can be negative. world_size is only the area covered by
+# the ground truth map (if any).
+class TiledOccupancyGrid():
+    # Offset of the tile coordinates when packing cells into a single integer key
+    KEY_OFFSET = 1 << 20
+
+    def __init__(self, world_size=200, resolution=1, limit=EVIDENCE_LIMIT, tile_size=TILE_SIZE):
+        self.world_size = world_size # Size of the world covered by the ground truth (meters)
+        self.resolution = resolution # Number of cells per meter
+        self.size = int(round(world_size * resolution)) # Size of the ground truth area (cells)
+        self.limit = limit
+        self.tile_size = tile_size
+        self.tiles = {} # (tile_y, tile_x) -> int16 evidence of the tile
+        self.overviews = {} # (level, tile_y, tile_x) -> tile downsampled 2**level times
+
+    def copy(self):
+        grid = TiledOccupancyGrid(self.world_size, self.resolution, self.limit, self.tile_size)
+        grid.tiles = {key: tile.copy() for key, tile in self.tiles.items()}
+        return grid
+
+    def resample(self, image):
+        return resample_to_grid(image, self.size)
+
+    # Convert world positions (in cells, not rounded) to cell indices
+    def to_cells(self, x_world, y_world):
+        return np.int_(np.floor(x_world)), np.int_(np.floor(y_world))
+
+    # Split cells into their tile and their index inside of the tile, packed into one integer key
+    def cell_keys(self, x_cells, y_cells):
+        tile_y, local_y = np.divmod(y_cells, self.tile_size)
+        tile_x, local_x = np.divmod(x_cells, self.tile_size)
+        tile_keys = (tile_y + self.KEY_OFFSET) * (2 * self.KEY_OFFSET) + (tile_x + self.KEY_OFFSET)
+        return tile_keys * (self.tile_size ** 2) + local_y * self.tile_size + local_x
+
+    def split_key(self, tile_key):
+        tile_y, tile_x = divmod(int(tile_key), 2 * self.KEY_OFFSET)
+        return tile_y - self.KEY_OFFSET, tile_x - self.KEY_OFFSET
+
+    # Same as OccupancyGrid.update, allocating the tiles on first use
+    def update(self, x_cells, y_cells, increments):
+        keys, counts = np.unique(self.cell_keys(x_cells, y_cells), return_counts=True)
+        if len(keys) == 0:
+            return
+        tile_keys, local = np.divmod(keys, self.tile_size ** 2)
+        # keys are sorted, so the cells of each tile are contiguous
+        tile_starts = np.flatnonzero(np.diff(tile_keys, prepend=-1))
+        tile_stops = np.append(tile_starts[1:], len(keys))
+        for start, stop in zip(tile_starts, tile_stops):
+            tile_y, tile_x = self.split_key(tile_keys[start])
+            tile = self.tiles.get((tile_y, tile_x))
+            if tile is None:
+                tile = np.zeros((self.tile_size, self.tile_size, 3), dtype=np.int16)
+                self.tiles[(tile_y, tile_x)] = tile
+            ypos, xpos = np.divmod(local[start:stop], self.tile_size)
+            for channel in range(3):
+                values = tile[ypos, xpos, channel] + counts[start:stop] * increments[channel]
+                tile[ypos, xpos, channel] = np.clip(values, -self.limit, self.limit)
+            # The overviews of this tile are out of date
+            for level in range(1, self.tile_size.bit_length()):
+                self.overviews.pop((level, tile_y, tile_x), None)
+
+    # Evidence of a channel at the given cells (0 where nothing has been observed)
+    def values(self, x_cells, y_cells, channel):
+        result = np.zeros(len(x_cells), dtype=np.int16)
+        tile_keys, local = np.divmod(self.cell_keys(x_cells, y_cells), self.tile_size ** 2)
+        for tile_key in np.unique(tile_keys):
+            tile = self.tiles.get(self.split_key(tile_key))
+            if tile is not None:
+                in_tile = tile_keys == tile_key
+                ypos, xpos = np.divmod(local[in_tile], self.tile_size)
+                result[in_tile] = tile[ypos, xpos, channel]
+        return result
+
+    # Tile downsampled 2**level times (mean of each block of cells), cached until the tile changes
+    def overview(self, level, tile_y, tile_x):
+        tile = self.tiles[(tile_y, tile_x)]
+        if level == 0:
+            return tile
+        key = (level, tile_y, tile_x)
+        if key not in self.overviews:
+            size = self.tile_size >> level
+            factor = 1 << level
+            blocks = tile.reshape(size, factor, size, factor, 3)
+            self.overviews[key] = blocks.mean(axis=(1, 3)).astype(np.int16)
+        return self.overviews[key]
+
+    # Overview of the explored area, at the finest level of the pyramid that fits in max_size pixels
+    def display_map(self, max_size):
+        if not self.tiles:
+            return np.zeros((max_size, max_size, 3), dtype=np.int16), 0, 0, 1
+        tile_ys = [tile_y for tile_y, _ in self.tiles]
+        tile_xs = [tile_x for _, tile_x in self.tiles]
+        min_y, min_x = min(tile_ys), min(tile_xs)
+        rows = (max(tile_ys) - min_y + 1) * self.tile_size
+        cols = (max(tile_xs) - min_x + 1) * self.tile_size
+        level = 0
+        while max(rows, cols) >> level > max_size and (self.tile_size >> level) > 1:
+            level += 1
+        size = self.tile_size >> level
+        image = np.zeros((rows >> level, cols >> level, 3), dtype=np.int16)
+        for tile_y, tile_x in self.tiles:
+            top = (tile_y - min_y) * size
+            left = (tile_x - min_x) * size
+            image[top:top + size, left:left + size] = self.overview(level, tile_y, tile_x)
+        return image, min_x * self.tile_size, min_y * self.tile_size, 1 << level
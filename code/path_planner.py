@@ -0,0 +1,205 @@
+import heapq
+import math
+import threading
+import numpy as np
+import cv2
+from occupancy_grid import OBSTACLE_CHANNEL, NAVIGABLE_CHANNEL
+
+# Kinds of cells of the cost map
+UNKNOWN = 0
+FREE    = 1
+BLOCKED = 2
+
+# Cost of crossing a cell of each kind (the length of the step is multiplied by it)
+FREE_COST    = 1
+UNKNOWN_COST = 4 # cells that haven't been seen yet are allowed, but known terrain is preferred
+WALL_COST    = 8 # extra cost of the cells next to an obstacle, keeps paths away from the walls
+
+# Maximum number of cells expanded by the search on each frame, so planning cost per frame is bounded
+# (a search that needs more keeps going on the next frames)
+MAX_EXPANSIONS = 500
+# The path is followed by steering toward the point this far ahead of the rover on the path (meters)
+LOOKAHEAD = 3
+# The rover replans when it gets further than this from the path (meters)
+MAX_DEVIATION = 3
+
+# Neighbors of a cell (dx, dy, step length)
+neighbors = [(-1, 0, 1.0), (1, 0, 1.0), (0, -1, 1.0), (0, 1, 1.0),
+             (-1, -1, math.sqrt(2)), (1, -1, math.sqrt(2)), (-1, 1, math.sqrt(2)), (1, 1, math.sqrt(2))]
+
+# Define a function to calculate the cost of every cell of a block of cell kinds
+def cell_costs(kinds):
+    blocked = kinds == BLOCKED
+    near_wall = cv2.dilate(blocked.astype(np.uint8), np.ones((3, 3), np.uint8)) > 0
+    costs = np.where(kinds == FREE, FREE_COST, UNKNOWN_COST) + WALL_COST * near_wall
+    return np.where(blocked, np.inf, costs)
+
+# A* search from a start cell to a goal cell over a snapshot of the cost map,
+# which can be run a bounded number of expansions at a time
+class PathSearch():
+    def __init__(self, costs, start, goal):
+        self.height, self.width = costs.shape
+        self.costs = costs.ravel().tolist() # plain floats are much faster to read one at a time
+        self.start = start[1] * self.width + start[0]
+        self.goal = goal[1] * self.width + goal[0]
+        self.best = {self.start: 0.0} # cell -> lowest cost found to get there
+        self.came_from = {}
+        self.closed = set()
+        self.open = [(self.heuristic(self.start), self.start)]
+        self.done = False
+        self.path = None # (x, y) cells from start to goal once found (None if there is no path)
+
+    # Octile distance to the goal (every cell costs at least FREE_COST, so it never overestimates)
+    def heuristic(self, cell):
+        dx = abs(cell % self.width - self.goal % self.width)
+        dy = abs(cell // self.width - self.goal // self.width)
+        return FREE_COST * (dx + dy + (math.sqrt(2) - 2) * min(dx, dy))
+
+    # Expand up to max_expansions cells. Returns True once the search is over.
+    def run(self, max_expansions):
+        width, height, costs, goal = self.width, self.height, self.costs, self.goal
+        best, came_from, closed, open_cells = self.best, self.came_from, self.closed, self.open
+        goal_x, goal_y = goal % width, goal // width
+        diagonal = math.sqrt(2) - 2
+        inf = math.inf
+        while open_cells and max_expansions > 0:
+            _, cell = heapq.heappop(open_cells)
+            if cell == goal:
+                self.path = self.trace_path()
+                self.done = True
+                return True
+            if cell in closed:
+                continue
+            closed.add(cell)
+            max_expansions -= 1
+            cell_cost = best[cell]
+            x, y = cell % width, cell // width
+            for dx, dy, step in neighbors:
+                nx, ny = x + dx, y + dy
+                if nx < 0 or nx >= width or ny < 0 or ny >= height:
+                    continue
+                neighbor = ny * width + nx
+                cost = costs[neighbor]
+                if cost == inf:
+                    if neighbor != goal:
+                        continue
+                    cost = FREE_COST # the goal is always reachable if its neighbors are
+                new_cost = cell_cost + step * cost
+                if new_cost < best.get(neighbor, inf):
+                    best[neighbor] = new_cost
+                    came_from[neighbor] = cell
+                    # same as self.heuristic(neighbor), inlined as this is the inner loop
+                    dx, dy = abs(nx - goal_x), abs(ny - goal_y)
+                    heuristic = FREE_COST * (dx + dy + diagonal * (dx if dx < dy else dy))
+                    heapq.heappush(open_cells, (new_cost + heuristic, neighbor))
+        if not open_cells:
+            self.done = True # no path
+        return self.done
+
+    def trace_path(self):
+        cells = [self.goal]
+        while cells[-1] != self.start:
+            cells.append(self.came_from[cells[-1]])
+        cells = np.array(cells[::-1])
+        return np.stack((cells % self.width, cells // self.width), axis=1)
+
+# Plans paths over the worldmap (navigable cells are free, obstacle cells are blocked).
+# The cost map is cached and updated with the cells perception writes to, and a path is
+# only replanned when the cost of one of its cells goes up, when the rover strays from it,
+# or when the goal changes. The planner covers the ground truth area of the worldmap
+# (it isn't used with a tiled worldmap, which can grow beyond it).
+# In pipelined mode the cost map is updated by the perception thread while the decision thread
+# plans on it: both hold lock (which the frontier explorer shares) while they use the planner.
+class PathPlanner():
+    def __init__(self, grid, max_expansions=MAX_EXPANSIONS):
+        self.resolution = grid.resolution
+        self.size = grid.size
+        self.max_expansions = max_expansions
+        self.kinds = np.full((self.size, self.size), UNKNOWN, dtype=np.int8)
+        self.costs = cell_costs(self.kinds)
+        self.goal = None # goal cell (x, y)
+        self.path = None # (x, y) cells of the current path
+        self.on_path = np.zeros((self.size, self.size), dtype=bool)
+        self.path_changed = False # the cost of a cell of the path went up
+        self.search = None # search in progress
+        self.unreachable = False # the last search found no way to the goal
+        self.lock = threading.RLock()
+
+    # Update the cost map for the cells (x, y) of the worldmap grid that were just written to.
+    # Returns the (rows, columns) slices of the area where cell kinds changed, or None.
+    def update(self, grid, x_cells, y_cells):
+        inside = (x_cells >= 0) & (x_cells < self.size) & (y_cells >= 0) & (y_cells < self.size)
+        written = np.zeros(self.size * self.size, dtype=bool)
+        written[np.ravel_multi_index((y_cells[inside], x_cells[inside]), self.kinds.shape)] = True
+        ypos, xpos = np.unravel_index(np.flatnonzero(written), self.kinds.shape)
+        if len(xpos) == 0:
+            return None
+        navigable = grid.values(xpos, ypos, NAVIGABLE_CHANNEL).astype(np.int32)
+        obstacle = grid.values(xpos, ypos, OBSTACLE_CHANNEL).astype(np.int32)
+        # Whichever has the most evidence, the map is fuzzy next to the walls
+        kinds = np.where((obstacle > 0) & (obstacle >= navigable), BLOCKED,
+                         np.where(navigable > 0, FREE, UNKNOWN))
+        # The decision thread may be planning on the cost map meanwhile
+        with self.lock:
+            changed = kinds != self.kinds[ypos, xpos]
+            if not changed.any():
+                return None
+            ypos, xpos = ypos[changed], xpos[changed]
+            self.kinds[ypos, xpos] = kinds[changed]
+            # Costs depend on the neighbors of a cell, so the area around the changes is recalculated
+            top, bottom = max(ypos.min() - 1, 0), min(ypos.max() + 2, self.size)
+            left, right = max(xpos.min() - 1, 0), min(xpos.max() + 2, self.size)
+            outer_top, outer_left = max(top - 1, 0), max(left - 1, 0)
+            costs = cell_costs(self.kinds[outer_top:bottom + 1, outer_left:right + 1])
+            costs = costs[top - outer_top:bottom - outer_top, left - outer_left:right - outer_left]
+            window = (slice(top, bottom), slice(left, right))
+            if (self.on_path[window] & (costs > self.costs[window])).any():
+                self.path_changed = True
+            self.costs[window] = costs
+            return window
+
+    def to_cell(self, pos):
+        return tuple(np.clip(np.int_(np.floor(np.array(pos[:2]) * self.resolution)), 0, self.size - 1))
+
+    def set_path(self, path):
+        self.on_path[:] = False
+        self.path = path
+        if path is not None:
+            self.on_path[path[:, 1], path[:, 0]] = True
+        self.path_changed = False
+
+    # Next point (meters) to steer toward to get from pos to goal_pos, or None while there is no path
+    # (the search takes a few frames on a large map, or there is no known way)
+    def next_waypoint(self, pos, goal_pos):
+        with self.lock:
+            start = self.to_cell(pos)
+            goal = self.to_cell(goal_pos)
+            if goal != self.goal:
+                self.goal = goal
+                self.search = None
+                self.unreachable = False
+                self.set_path(None)
+
+            closest = 0
+            if self.path is not None:
+                dists = np.hypot(self.path[:, 0] - start[0], self.path[:, 1] - start[1])
+                closest = np.argmin(dists)
+                if self.path_changed or dists[closest] > MAX_DEVIATION * self.resolution:
+                    self.set_path(None)
+
+            if self.path is None:
+                if self.search is None:
+                    self.search = PathSearch(self.costs, start, goal)
+                if not self.search.run(self.max_expansions):
+                    return None
+                path = self.search.path
+                self.search = None
+                self.unreachable = path is None
+                # Cells may have been blocked while the search was running over several frames
+                if path is None or np.isinf(self.costs[path[1:-1, 1], path[1:-1, 0]]).any():
+                    return None
+                self.set_path(path)
+                closest = 0
+
+            target = self.path[min(closest + int(LOOKAHEAD * self.resolution), len(self.path) - 1)]
+            return (target[0] + 0.5) / self.resolution, (target[1] + 0.5) / self.resolution
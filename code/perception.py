@@ -1,5 +1,7 @@
 import numpy as np
 import cv2
+from camera import CameraModel
+from profiler import profiler
 
 # Identify pixels above the threshold
 def color_thresh(img, rgb_thresh_low=None, rgb_thresh_high=None):
@@ -38,8 +40,8 @@ def rover_coords(binary_img):
     ypos, xpos = binary_img.nonzero()
     # Calculate pixel positions with reference to the rover position being at the 
     # center bottom of the image.  
-    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[0]).astype(np.float)
+    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(np.float64)
+    y_pixel = -(xpos - binary_img.shape[0]).astype(np.float64)
     return x_pixel, y_pixel
 
 
@@ -83,6 +85,15 @@ def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
     # Return the result
     return x_pix_world, y_pix_world
 
+# Define a function to convert rover-centric pixels to cells of a worldmap grid
+# (clipped to the grid if it has a fixed size)
+def pix_to_cells(xpix, ypix, xpos, ypos, yaw, grid, scale):
+    # Apply rotation
+    xpix_rot, ypix_rot = rotate_pix(xpix, ypix, yaw)
+    # Apply translation
+    xpix_tran, ypix_tran = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
+    return grid.to_cells(xpix_tran, ypix_tran)
+
 # Define a function to perform a perspective transform
 def perspect_transform(img, src, dst):
     M = cv2.getPerspectiveTransform(src, dst)
@@ -102,54 +113,137 @@ def object_distance(dists, angles, degree):
 
 
 
+# Label bits of the fused color classifier, one per kind of object.
+# A pixel can be more than one kind (e.g. both navigable and obstacle) just like
+# with separate color_thresh calls, so the labels are bit flags.
+OBSTACLE  = 1
+ROCK      = 2
+NAVIGABLE = 4
+
+# Color thresholds (label, low, high) of each kind of object in the warped image.
+# Same meaning as the rgb_thresh_low/rgb_thresh_high arguments of color_thresh.
+color_thresholds = [(OBSTACLE,  None,          (118,103,120)),
+                    (ROCK,      (125,102,0),   (204,185,78)),
+                    (NAVIGABLE, (118, 93, 89), None)]
+
+# Evidence increments of the worldmap channels (obstacle/red, rock/green, navigable/blue)
+# for each observed pixel of each kind of object: more of its own channel, less of the others
+map_increments = {OBSTACLE:  ( 5, -2, -2),
+                  ROCK:      (-2,  5, -2),
+                  NAVIGABLE: (-2, -2,  5)}
+
+# Build one lookup table per color channel: for each channel value, the labels whose
+# threshold is satisfied on that channel. A pixel gets a label only if all 3 channels agree.
+def build_label_luts(thresholds):
+    luts = np.zeros((3, 256), dtype=np.uint8)
+    values = np.arange(256)
+    for label, rgb_thresh_low, rgb_thresh_high in thresholds:
+        for channel in range(3):
+            within = np.ones(256, dtype=bool)
+            if rgb_thresh_low is not None:
+                within &= values >= rgb_thresh_low[channel]
+            if rgb_thresh_high is not None:
+                within &= values <= rgb_thresh_high[channel]
+            luts[channel, within] |= label
+    return luts
+
+label_luts = build_label_luts(color_thresholds)
+
+# Display colors of each label combination, used to render Rover.vision_labels
+# (obstacle in red, rock in green and navigable in blue channel)
+label_colors = np.array([[(label & OBSTACLE) != 0, (label & ROCK) != 0, (label & NAVIGABLE) != 0]
+                         for label in range(8)], dtype=np.uint8) * 255
+
+# Classify uint8 RGB pixels into a single uint8 label image in one pass over the pixels
+def classify(img, luts=label_luts):
+    labels = luts[0][img[..., 0]]
+    labels &= luts[1][img[..., 1]]
+    labels &= luts[2][img[..., 2]]
+    return labels
+
+
+# Size of the square in the top-down view that corresponds to 1 square meter
+dst_size = 5
+# Calibration points of the perspective transform in the camera image
+source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+
+# Directions (degrees, 0 is straight ahead, positive to the left) in which the distance to the
+# closest obstacle is measured, +/- 3 degrees. Includes the front (0) and side (35, -35) walls.
+range_probe_angles = list(range(-45, 50, 5))
+
+# Size of the Gaussian blur applied to the camera image
+blur_size = 11
+
+# Calibrated camera models, one per camera image shape and maximum range (meters, None for no limit)
+camera_models = {}
+
+def get_camera_model(img_shape, max_range=None):
+    img_shape = tuple(img_shape[:2])
+    if (img_shape, max_range) not in camera_models:
+        img_width = img_shape[0]
+        img_height = img_shape[1]
+        destination = np.float32([[img_height/2 - dst_size, img_width],
+                          [img_height/2 + dst_size, img_width],
+                          [img_height/2 + dst_size, img_width - 2 * dst_size], 
+                          [img_height/2 - dst_size, img_width - 2 * dst_size],
+                          ])
+        max_range_pixels = None if max_range is None else max_range * 2 * dst_size
+        camera_models[img_shape, max_range] = CameraModel(source, destination, img_shape, max_range_pixels)
+    return camera_models[img_shape, max_range]
+
+# Blur the rows of the camera image the perspective transform reads (with the rows the blur
+# needs around them, so they are blurred exactly like in the full image), the sky is skipped.
+# Returns the blurred rows and the camera image row they start at.
+def blur_source_rows(camera, img):
+    rows = camera.source_rows(blur_size // 2)
+    return cv2.GaussianBlur(img[rows], (blur_size, blur_size), 0), rows.start
+
+
 # Measures and calculates the fields of the rover state based on sensor data
+# (each phase is timed by the profiler when it is enabled)
 def perception_step(Rover):
     
-    # 1) Define constants like source and destination points for perspective transform
+    # 1) Get the calibrated camera model (the perspective transform is computed only once)
     img = Rover.img
-    dst_size = 5 
-    source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
-    img_width = img.shape[0]
-    img_height = img.shape[1]    
-    destination = np.float32([[img_height/2 - dst_size, img_width],
-                      [img_height/2 + dst_size, img_width],
-                      [img_height/2 + dst_size, img_width - 2 * dst_size], 
-                      [img_height/2 - dst_size, img_width - 2 * dst_size],
-                      ])
+    camera = get_camera_model(img.shape, Rover.perception_range)
    
-    # Blur image to reduce noise
-    img = cv2.GaussianBlur(img, (11, 11), 0)
-
-    # 2) Apply perspective transform
-    warped = perspect_transform(img, source, destination)
-
-    # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples    
-    navigable = color_thresh(warped, (118, 93, 89))
-    rock      = color_thresh(warped, (125,102,0), (204,185,78))
-    obstacle  = color_thresh(warped, None, (118,103,120))
-
-    # 4) Update Rover.vision_image (this will be displayed on left side of screen)
-    Rover.vision_image[:,:,0] = obstacle * 255  # red channel
-    Rover.vision_image[:,:,1] = rock * 255      # green channel
-    Rover.vision_image[:,:,2] = navigable * 255 # blue channel
-
-    # 5) Convert map image pixel values to rover-centric coords
-    navigable_x_rover, navigable_y_rover = rover_coords(navigable)
-    rock_x_rover, rock_y_rover           = rover_coords(rock)
-    obstacle_x_rover, obstacle_y_rover   = rover_coords(obstacle)
-
-    # 6) Convert rover-centric pixel values to world coordinates
-    yaw = Rover.yaw
-    world_size = Rover.worldmap.shape[0]
-    world_scale = dst_size * 2
-    world_x = Rover.pos[0]   
-    world_y = Rover.pos[1]
-    navigable_x_world, navigable_y_world = pix_to_world(navigable_x_rover, navigable_y_rover, 
-                                                        world_x, world_y, yaw, world_size, world_scale)
-    rock_x_world, rock_y_world           = pix_to_world(rock_x_rover, rock_y_rover, 
-                                                        world_x, world_y, yaw, world_size, world_scale)
-    obstacle_x_world, obstacle_y_world   = pix_to_world(obstacle_x_rover, obstacle_y_rover, 
-                                                        world_x, world_y, yaw, world_size, world_scale)
+    # Blur image to reduce noise (only the part of it seen in the top-down view)
+    with profiler.stage('perception.blur'):
+        img, first_row = blur_source_rows(camera, img)
+
+    # 2) Apply perspective transform, only to the pixels that are visible in the top-down view
+    with profiler.stage('perception.warp'):
+        warped = camera.warp_visible(img, first_row)
+
+    # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples,
+    #    all at once into a single label image
+    with profiler.stage('perception.threshold'):
+        labels    = classify(warped)
+        navigable = (labels & NAVIGABLE) != 0
+        rock      = (labels & ROCK) != 0
+        obstacle  = (labels & OBSTACLE) != 0
+
+        # 4) Update Rover.vision_labels (this will be displayed on left side of screen)
+        np.put(Rover.vision_labels, camera.visible_index, labels)
+
+    with profiler.stage('perception.coords'):
+        # 5) Convert map image pixel values to rover-centric coords
+        navigable_x_rover, navigable_y_rover = camera.x_rover[navigable], camera.y_rover[navigable]
+        rock_x_rover, rock_y_rover           = camera.x_rover[rock], camera.y_rover[rock]
+        obstacle_x_rover, obstacle_y_rover   = camera.x_rover[obstacle], camera.y_rover[obstacle]
+
+        # 6) Convert rover-centric pixel values to worldmap cells
+        yaw = Rover.yaw
+        grid = Rover.worldmap
+        world_scale = dst_size * 2 / grid.resolution # warped image pixels per map cell
+        world_x = Rover.pos[0] * grid.resolution
+        world_y = Rover.pos[1] * grid.resolution
+        navigable_x_world, navigable_y_world = pix_to_cells(navigable_x_rover, navigable_y_rover, 
+                                                            world_x, world_y, yaw, grid, world_scale)
+        rock_x_world, rock_y_world           = pix_to_cells(rock_x_rover, rock_y_rover, 
+                                                            world_x, world_y, yaw, grid, world_scale)
+        obstacle_x_world, obstacle_y_world   = pix_to_cells(obstacle_x_rover, obstacle_y_rover, 
+                                                            world_x, world_y, yaw, grid, world_scale)
     
     # 7) Update Rover worldmap (to be displayed on right side of screen)
 
@@ -157,39 +251,54 @@ def perception_step(Rover):
     if not (Rover.pitch <= 2 or Rover.pitch >= 358) or not (Rover.roll <= 2 or Rover.roll >= 358):
         return Rover
     
-    # Update color by channel depending on the kind of object
-    Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] += 5 # more red
-    Rover.worldmap[obstacle_y_world, obstacle_x_world, 1] -= 2 # less green
-    Rover.worldmap[obstacle_y_world, obstacle_x_world, 2] -= 2 # less blue
-
-    Rover.worldmap[rock_y_world, rock_x_world, 0] -= 2 # less red
-    Rover.worldmap[rock_y_world, rock_x_world, 1] += 5 # more green
-    Rover.worldmap[rock_y_world, rock_x_world, 2] -= 2 # less blue
+    with profiler.stage('perception.map_update'):
+        # Accumulate the evidence of every observed pixel by channel depending on the kind of object
+        grid.update(obstacle_x_world, obstacle_y_world, map_increments[OBSTACLE])
+        grid.update(rock_x_world, rock_y_world, map_increments[ROCK])
+        grid.update(navigable_x_world, navigable_y_world, map_increments[NAVIGABLE])
 
-    Rover.worldmap[navigable_y_world, navigable_x_world, 0] -= 2 # less red
-    Rover.worldmap[navigable_y_world, navigable_x_world, 1] -= 2 # less green
-    Rover.worldmap[navigable_y_world, navigable_x_world, 2] += 5 # more blue
+        # Update the map statistics and the cost map of the path planner
+        # for the cells that were just written to
+        written_x = np.concatenate((obstacle_x_world, rock_x_world, navigable_x_world))
+        written_y = np.concatenate((obstacle_y_world, rock_y_world, navigable_y_world))
+        Rover.map_statistics.update(grid, written_x, written_y)
+        # (the cost map and the frontier are changed together, the decision step may be planning on them)
+        if Rover.path_planner is not None:
+            with Rover.path_planner.lock:
+                changed_window = Rover.path_planner.update(grid, written_x, written_y)
+                if Rover.explorer is not None:
+                    Rover.explorer.update(changed_window)
 
     # Update Rover pixel distances and angles
-
-    # Calculate the distance to obstacle in front and sides
-    obstacle_dists, obstacle_angles = to_polar_coords(obstacle_x_rover, obstacle_y_rover)
-    
-    Rover.front_wall_distance = object_distance(obstacle_dists, obstacle_angles, 0)
-    Rover.left_wall_distance  = object_distance(obstacle_dists, obstacle_angles, 35)
-    Rover.right_wall_distance = object_distance(obstacle_dists, obstacle_angles, -35)
-    
-    # Calculate the distance and angle of the sample rock in view
-    rock_dists, rock_angles = to_polar_coords(rock_x_rover, rock_y_rover)
-    
-    Rover.rock_size = len(rock_dists)
-    if Rover.rock_size > 0:
-        Rover.rock_dist = np.mean(rock_dists)
-        Rover.rock_angle = np.mean(rock_angles * 180 / np.pi)
-        Rover.rock_pos = (np.mean(rock_x_world), np.mean(rock_y_world))
-    else:
-        Rover.rock_dist = 0
-        Rover.rock_angle = 0
-        Rover.rock_pos = None
+    with profiler.stage('perception.distances'):
+        # Calculate the distance to obstacles all around (the polar coordinates of the pixels
+        # are precomputed by the camera model), including in front and on the sides
+        Rover.obstacle_ranges = camera.probe_distances(obstacle, range_probe_angles)
+        Rover.front_wall_distance = Rover.obstacle_ranges[range_probe_angles.index(0)]
+        Rover.left_wall_distance  = Rover.obstacle_ranges[range_probe_angles.index(35)]
+        Rover.right_wall_distance = Rover.obstacle_ranges[range_probe_angles.index(-35)]
+        
+        # Calculate the distance and angle of the sample rock in view
+        rock_dists, rock_angles = camera.dists[rock], camera.angles[rock]
+        
+        Rover.rock_size = len(rock_dists)
+        if Rover.rock_size > 0:
+            Rover.rock_dist = np.mean(rock_dists)
+            Rover.rock_angle = np.mean(rock_angles * 180 / np.pi)
+            Rover.rock_pos = (np.mean(rock_x_world) / grid.resolution, np.mean(rock_y_world) / grid.resolution)
+            # Fuse the detection with the previous detections of the same rock, cell by cell
+            # as there may be more than one rock in view
+            rock_cells, rock_counts = np.unique(np.stack((rock_x_world, rock_y_world)), axis=1, return_counts=True)
+            with Rover.rock_registry.lock:
+                for (x, y), count in zip(rock_cells.T, rock_counts):
+                    Rover.rock_registry.add((x + 0.5) / grid.resolution, (y + 0.5) / grid.resolution,
+                                            int(count), Rover.total_time)
+        else:
+            Rover.rock_dist = 0
+            Rover.rock_angle = 0
+            Rover.rock_pos = None
+        # The rocks picked up since the last frame are the ones the rover is next to
+        while Rover.rock_registry.collected < Rover.samples_found:
+            Rover.rock_registry.mark_collected(Rover.pos)
 
     return Rover
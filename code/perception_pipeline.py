@@ -0,0 +1,126 @@
+import collections
+import threading
+import time
+from perception import perception_step
+from profiler import profiler
+
+# How long the control loop waits for the first perception result (seconds)
+FIRST_RESULT_TIMEOUT = 1.0
+
+# Fields of the rover state that perception_step reads from the telemetry, copied when a frame is
+# submitted (plus the fields create_output_images needs, as the insets are rendered from the result)
+input_fields = ['pos', 'yaw', 'pitch', 'roll', 'total_time', 'samples_pos', 'samples_found']
+# Fields of the rover state that perception_step sets, copied back to the rover
+result_fields = ['front_wall_distance', 'left_wall_distance', 'right_wall_distance', 'obstacle_ranges',
+                 'rock_size', 'rock_dist', 'rock_angle', 'rock_pos']
+
+# Rover state seen by the perception thread. The worldmap, its statistics and the vision labels
+# are only written by the perception thread. The path planner, the frontier explorer and the rock
+# registry are shared with the decision thread, which plans paths, chooses goals and looks for
+# rocks on them: both threads only use them while holding their lock (the lock of the path
+# planner for the planner and the explorer, the lock of the registry for the registry).
+class PerceptionState():
+    def __init__(self, Rover):
+        self.worldmap = Rover.worldmap
+        self.map_statistics = Rover.map_statistics
+        self.path_planner = Rover.path_planner
+        self.explorer = Rover.explorer
+        self.rock_registry = Rover.rock_registry
+        self.vision_labels = Rover.vision_labels
+        self.ground_truth = Rover.ground_truth
+        self.perception_range = Rover.perception_range
+        self.img = None
+        for field in input_fields + result_fields:
+            setattr(self, field, getattr(Rover, field, None))
+
+# Runs perception_step in a native thread, one frame behind the control loop at most.
+# Frames wait in a bounded queue; when it is full the oldest frame is dropped, so perception
+# always works on the most recent frames and never falls further behind when it is briefly
+# slower than the frame interval. The control loop never waits (except for the very first
+# result, FIRST_RESULT_TIMEOUT at most): it uses the most recent completed result.
+class PerceptionPipeline():
+    def __init__(self, Rover, on_result=None, queue_size=1):
+        self.state = PerceptionState(Rover)
+        self.on_result = on_result # Called from the perception thread with the state after each frame
+        self.frames = collections.deque(maxlen=queue_size) # (frame number, submit time, img, inputs)
+        self.condition = threading.Condition()
+        self.submitted = 0 # Number of frames submitted
+        self.dropped = 0 # Frames replaced by newer ones before perception got to them
+        self.result = None # (frame number, result fields) of the most recent completed frame
+        self.applied = 0 # Frame number of the last result copied to the rover
+        self.frames_behind = 0 # How many frames older than the rover that result was
+        self.error = None # Exception of the last frame perception failed on
+        self.first_result_deadline = None # The control loop waits for the first result until then
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Queue the current frame of the rover. The camera image is copied, as the telemetry decoder
+    # reuses its buffer for the next frame.
+    def submit(self, Rover):
+        inputs = {field: getattr(Rover, field) for field in input_fields}
+        inputs['pos'] = tuple(Rover.pos)
+        with self.condition:
+            self.submitted += 1
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append((self.submitted, time.perf_counter(), Rover.img.copy(), inputs))
+            self.condition.notify_all()
+
+    # Copy the most recent completed result to the rover, waiting for the first one if there
+    # is none yet. Returns False when there is still no result (perception failed on all the
+    # frames so far, see error, or is too slow): the rover is left as it was.
+    def apply_latest(self, Rover):
+        with self.condition:
+            if self.first_result_deadline is None:
+                self.first_result_deadline = time.perf_counter() + FIRST_RESULT_TIMEOUT
+            deadline = self.first_result_deadline
+            while self.result is None and self.error is None and time.perf_counter() < deadline:
+                self.condition.wait(deadline - time.perf_counter())
+            if self.result is None:
+                return False
+            frame, result = self.result
+        if frame != self.applied:
+            for field, value in result.items():
+                setattr(Rover, field, value)
+            self.applied = frame
+        self.frames_behind = self.submitted - frame
+        return True
+
+    # Stop the perception thread, once it is done with the frame it is working on
+    # (the frames waiting are dropped)
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def run(self):
+        state = self.state
+        while True:
+            with self.condition:
+                while not self.frames and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                frame, submit_time, state.img, inputs = self.frames.popleft()
+            for field, value in inputs.items():
+                setattr(state, field, value)
+            try:
+                with profiler.stage('perception_step'):
+                    perception_step(state)
+            except Exception as error:
+                # Keep the previous result rather than stopping perception
+                print("Perception failed on frame {}: {}".format(frame, error))
+                with self.condition:
+                    self.error = error
+                    self.condition.notify_all()
+                continue
+            result = {field: getattr(state, field) for field in result_fields}
+            with self.condition:
+                self.result = (frame, result)
+                self.condition.notify_all()
+            if profiler.enabled:
+                profiler.record('perception_pipeline.latency', time.perf_counter() - submit_time)
+            if self.on_result is not None:
+                self.on_result(state)
@@ -0,0 +1,238 @@
+# Offline perception over a recorded dataset (robot_log.csv + IMG folder)
+# Example: $ python process_dataset.py ../test_dataset/robot_log.csv --video ../output/test_mapping.mp4
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Pool, cpu_count
+
+import cv2
+import numpy as np
+import matplotlib.image as mpimg
+
+from perception import get_camera_model, blur_source_rows, classify, pix_to_cells, to_polar_coords, object_distance, \
+                       label_colors, map_increments, dst_size, OBSTACLE, ROCK, NAVIGABLE
+from supporting_functions import convert_to_float, render_worldmap
+from map_statistics import MapStatistics
+from occupancy_grid import OccupancyGrid
+
+# Same world as the one used by drive_rover.py
+world_size = 200
+
+# Paths are recorded relative to where the recording was made,
+# fall back to the IMG folder next to the log
+def find_image(img_path, log_dir):
+    if not os.path.isfile(img_path):
+        img_path = os.path.join(log_dir, 'IMG', os.path.basename(img_path.replace('\\', '/')))
+    return img_path
+
+# Define a function to read the frames of a recording
+def read_log(log_path):
+    log_dir = os.path.dirname(os.path.abspath(log_path))
+    frames = []
+    with open(log_path) as log_file:
+        for row in csv.DictReader(log_file, delimiter=';'):
+            frames.append((find_image(row['Path'], log_dir),
+                           convert_to_float(row['X_Position']),
+                           convert_to_float(row['Y_Position']),
+                           convert_to_float(row['Yaw']),
+                           convert_to_float(row['Pitch']),
+                           convert_to_float(row['Roll'])))
+    return frames
+
+# Worker: decode a frame and classify its visible pixels (steps 1-3 of perception_step)
+def classify_frame(img_path):
+    img = cv2.imread(img_path)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    camera = get_camera_model(img.shape)
+    img, first_row = blur_source_rows(camera, img)
+    return classify(camera.warp_visible(img, first_row))
+
+# Define a function to check if the rover is stable enough to update the map (same as perception_step)
+def is_stable(pitch, roll):
+    return ((pitch <= 2) | (pitch >= 358)) & ((roll <= 2) | (roll >= 358))
+
+# Define a function to update the worldmap with a batch of classified frames.
+# The pixels of the whole batch are converted to map cells at once, then the cells of each frame
+# are added in the same order as perception_step does (frame by frame, obstacle, rock then navigable),
+# so the map is the same as running perception_step on every frame whatever the batch size
+# (values are clamped after each update). Returns the updated cells.
+def update_worldmap(grid, camera, labels, xpos, ypos, yaw):
+    world_scale = dst_size * 2 / grid.resolution
+    frame_cells = []
+    for label in map_increments:
+        frame_idx, pix_idx = ((labels & label) != 0).nonzero()
+        x_world, y_world = pix_to_cells(camera.x_rover[pix_idx], camera.y_rover[pix_idx],
+                                        xpos[frame_idx] * grid.resolution, ypos[frame_idx] * grid.resolution,
+                                        yaw[frame_idx], grid, world_scale)
+        # frame_idx is sorted, so the cells of each frame are contiguous
+        bounds = np.searchsorted(frame_idx, np.arange(len(labels) + 1))
+        frame_cells.append((x_world, y_world, bounds))
+    for frame in range(len(labels)):
+        for (x_world, y_world, bounds), increments in zip(frame_cells, map_increments.values()):
+            start, stop = bounds[frame], bounds[frame + 1]
+            grid.update(x_world[start:stop], y_world[start:stop], increments)
+    return (np.concatenate([y_world for _, y_world, _ in frame_cells]),
+            np.concatenate([x_world for x_world, _, _ in frame_cells]))
+
+# Define a function to calculate the per-frame metrics of a batch of classified frames
+def frame_metrics(camera, labels, dists, angles):
+    metrics = []
+    for frame_labels in labels:
+        obstacle = (frame_labels & OBSTACLE) != 0
+        rock = (frame_labels & ROCK) != 0
+        rock_size = np.count_nonzero(rock)
+        metrics.append({
+            'navigable_pixels': np.count_nonzero(frame_labels & NAVIGABLE),
+            'rock_pixels': rock_size,
+            'obstacle_pixels': np.count_nonzero(obstacle),
+            'front_wall_distance': object_distance(dists[obstacle], angles[obstacle], 0),
+            'left_wall_distance': object_distance(dists[obstacle], angles[obstacle], 35),
+            'right_wall_distance': object_distance(dists[obstacle], angles[obstacle], -35),
+            'rock_dist': np.mean(dists[rock]) if rock_size > 0 else 0,
+            'rock_angle': np.mean(angles[rock] * 180 / np.pi) if rock_size > 0 else 0,
+        })
+    return metrics
+
+# Define a function to make a video frame: vision labels on top, worldmap below
+def render_frame(camera, frame_labels, grid, ground_truth):
+    vision_labels = np.zeros(camera.img_shape, dtype=np.uint8)
+    np.put(vision_labels, camera.visible_index, frame_labels)
+    map_add, _ = render_worldmap(grid.evidence, ground_truth)
+    rows, cols = camera.img_shape
+    output_image = np.zeros((rows + map_add.shape[0], max(cols, map_add.shape[1]), 3), dtype=np.uint8)
+    output_image[:rows, :cols] = label_colors[vision_labels]
+    output_image[rows:, :map_add.shape[1]] = np.flipud(map_add).clip(0, 255)
+    return output_image
+
+def process_dataset(log_path, output_dir, workers, batch_size, video_path=None, video_fps=60, map_resolution=1):
+    frames = read_log(log_path)
+    if not frames:
+        raise SystemExit('No frames in {}'.format(log_path))
+    xpos, ypos, yaw, pitch, roll = np.array([frame[1:] for frame in frames]).T
+    stable = is_stable(pitch, roll)
+
+    ground_truth = mpimg.imread('../calibration_images/map_bw.png')
+    ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float64)
+    grid = OccupancyGrid(world_size=world_size, resolution=map_resolution)
+    ground_truth_3d = grid.resample(ground_truth_3d)
+    map_statistics = MapStatistics(ground_truth_3d)
+
+    camera = None
+    video = None
+    metrics = []
+    start_time = time.time()
+    with Pool(workers) as pool:
+        decoded = pool.imap(classify_frame, [frame[0] for frame in frames], chunksize=8)
+        for start in range(0, len(frames), batch_size):
+            stop = min(start + batch_size, len(frames))
+            labels = np.stack([next(decoded) for _ in range(start, stop)])
+            if camera is None:
+                camera = get_camera_model(cv2.imread(frames[0][0]).shape)
+                dists, angles = to_polar_coords(camera.x_rover, camera.y_rover)
+
+            metrics.extend(frame_metrics(camera, labels, dists, angles))
+
+            batch = np.arange(start, stop)[stable[start:stop]]
+            if video_path is None:
+                y_world, x_world = update_worldmap(grid, camera, labels[batch - start],
+                                                   xpos[batch], ypos[batch], yaw[batch])
+                map_statistics.update(grid, x_world, y_world)
+            else:
+                # The video shows the map after every frame, so update it one frame at a time
+                for idx in range(start, stop):
+                    if stable[idx]:
+                        y_world, x_world = update_worldmap(grid, camera, labels[idx - start:idx - start + 1],
+                                                           xpos[idx:idx + 1], ypos[idx:idx + 1], yaw[idx:idx + 1])
+                        map_statistics.update(grid, x_world, y_world)
+                    output_image = render_frame(camera, labels[idx - start], grid, ground_truth_3d)
+                    if video is None:
+                        video = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), video_fps,
+                                                (output_image.shape[1], output_image.shape[0]))
+                    video.write(cv2.cvtColor(output_image, cv2.COLOR_RGB2BGR))
+
+            print('{}/{} frames, mapped: {}%, fidelity: {}%'.format(stop, len(frames),
+                  map_statistics.perc_mapped(), map_statistics.fidelity()))
+
+    if video is not None:
+        video.release()
+    elapsed = time.time() - start_time
+    print('Processed {} frames in {:.2f} s ({:.1f} FPS)'.format(len(frames), elapsed, len(frames) / elapsed))
+
+    # Save the final worldmap and the per-frame metrics
+    map_add, _ = render_worldmap(grid.evidence, ground_truth_3d)
+    cv2.imwrite(os.path.join(output_dir, 'worldmap.png'),
+                cv2.cvtColor(np.flipud(map_add).clip(0, 255).astype(np.uint8), cv2.COLOR_RGB2BGR))
+    np.save(os.path.join(output_dir, 'worldmap.npy'), grid.evidence)
+    with open(os.path.join(output_dir, 'metrics.csv'), 'w', newline='') as metrics_file:
+        writer = csv.writer(metrics_file, delimiter=';')
+        writer.writerow(['Path', 'Stable'] + list(metrics[0].keys()))
+        for frame, stable_frame, frame_metric in zip(frames, stable, metrics):
+            writer.writerow([frame[0], int(stable_frame)] + list(frame_metric.values()))
+
+    return grid, metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline perception over a recorded dataset')
+    parser.add_argument(
+        'log',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of the recording.'
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='../output',
+        help='Folder where the worldmap and the per-frame metrics are saved.'
+    )
+    parser.add_argument(
+        '--video',
+        type=str,
+        default=None,
+        help='Path of an optional output video of the mapping.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=cpu_count(),
+        help='Number of worker processes decoding and classifying frames.'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=256,
+        help='Number of frames mapped at once.'
+    )
+    parser.add_argument(
+        '--map-resolution',
+        type=float,
+        default=1,
+        help='Resolution of the worldmap in cells per meter.'
+    )
+    parser.add_argument(
+        '--check-batching',
+        action='store_true',
+        help='Also map the dataset one frame at a time and check that the worldmap is the same '
+             '(exit status 1 if it is not).'
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    grid, _ = process_dataset(args.log, args.output, args.workers, args.batch_size, args.video,
+                              map_resolution=args.map_resolution)
+    if args.check_batching:
+        with tempfile.TemporaryDirectory() as check_dir:
+            single_grid, _ = process_dataset(args.log, check_dir, args.workers, 1,
+                                             map_resolution=args.map_resolution)
+        differences = np.count_nonzero(grid.evidence != single_grid.evidence)
+        if differences > 0:
+            print('Batches of {} frames and single frames differ on {} worldmap values'.format(
+                  args.batch_size, differences))
+            sys.exit(1)
+        print('Batches of {} frames give the same worldmap as single frames'.format(args.batch_size))
@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import numpy as np
+
+# Number of most recent timings kept for each stage
+HISTORY_SIZE = 2000
+# Percentiles reported for each stage
+PERCENTILES = [50, 90, 95, 99]
+# Edges of the latency histogram buckets (milliseconds)
+HISTOGRAM_EDGES = np.concatenate(([0], np.logspace(-2, 3, 26)))
+
+# Records how long each stage of the telemetry loop takes, in a fixed size ring buffer per stage.
+# Timing is off until enabled, and then costs about a microsecond per stage.
+class StageProfiler():
+    def __init__(self, history_size=HISTORY_SIZE):
+        self.enabled = False
+        self.history_size = history_size
+        self.timings = {} # stage -> ring buffer of the last timings (milliseconds)
+        self.counts = {} # stage -> total number of timings recorded
+        self.lock = threading.Lock() # stages can be timed from several threads
+        self.server = None
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    # Record the duration (seconds) of a stage
+    def record(self, name, duration):
+        with self.lock:
+            if name not in self.timings:
+                self.timings[name] = np.zeros(self.history_size)
+                self.counts[name] = 0
+            self.timings[name][self.counts[name] % self.history_size] = duration * 1000
+            self.counts[name] += 1
+
+    # Latency statistics of every stage over its recorded history
+    def summary(self):
+        with self.lock:
+            timings = {name: ring[:min(self.counts[name], self.history_size)].copy()
+                       for name, ring in self.timings.items()}
+            counts = dict(self.counts)
+        summary = {}
+        for name, values in timings.items():
+            percentiles = np.percentile(values, PERCENTILES)
+            histogram, _ = np.histogram(values, HISTOGRAM_EDGES)
+            summary[name] = {
+                'count': counts[name],
+                'mean_ms': float(np.mean(values)),
+                'max_ms': float(np.max(values)),
+                'percentiles_ms': {str(p): float(v) for p, v in zip(PERCENTILES, percentiles)},
+                'histogram': {'edges_ms': HISTOGRAM_EDGES.tolist(), 'counts': histogram.tolist()},
+            }
+        return summary
+
+    # Write the summary to a JSON file
+    def export(self, path):
+        with open(path, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+
+    # Serve the summary as JSON on http://localhost:<port>/ from a background thread
+    def serve(self, port):
+        profiler = self
+
+        class SummaryHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(profiler.summary(), indent=2).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # don't print every request
+
+        self.server = HTTPServer(('localhost', port), SummaryHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+# Profiler shared by all stages of the telemetry loop
+profiler = StageProfiler()
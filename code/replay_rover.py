@@ -0,0 +1,176 @@
+# Headless stand-in for the simulator: feeds telemetry to the telemetry handler of drive_rover.py
+# directly (no socket, no Unity, no GPU) and records the commands it sends back.
+# Telemetry either replays a recording (open loop: the rover follows the recording whatever the
+# commands are) or comes from a rover simulated on the ground truth map (closed loop).
+# Time is simulated, so a replay runs as fast as the pipeline allows and is repeatable.
+# Example: $ python replay_rover.py --recording ../test_dataset/robot_log.csv --commands ../output/commands.csv
+#          $ python replay_rover.py --frames 3000 --summary ../output/replay.json -- --inset-rate 0
+import argparse
+import csv
+import json
+import random
+import time
+
+import numpy as np
+
+import drive_rover
+import state_snapshot
+from rover_state import ground_truth
+from telemetry_sources import RecordingReplay, MapSimulator, SimulatedClock, place_samples, \
+                              SAMPLE_COUNT, FRAME_RATE
+
+# Stand-in for the socketio server of drive_rover.py: records everything it would emit
+class ReplayServer():
+    def __init__(self):
+        self.events = [] # (event, data) in the order they were emitted
+
+    def emit(self, event, data=None, **kwargs):
+        self.events.append((event, data))
+
+# Define a function to run the telemetry handler of drive_rover.py on a telemetry source
+def replay(source, frames, frame_rate=FRAME_RATE, commands_path='', resume=None):
+    server = ReplayServer()
+    drive_rover.sio = server
+    session = drive_rover.get_session('replay')
+    clock = SimulatedClock()
+    session.Rover.clock = clock
+    if resume is not None:
+        # Continue from a saved state: the rover time goes on from it (the maps start empty)
+        state_snapshot.restore(session.Rover, resume)
+        session.Rover.start_time = clock.time - session.Rover.total_time
+        source.move_to(session.Rover.pos, session.Rover.yaw)
+    dt = 1.0 / frame_rate
+
+    commands_file = None
+    if commands_path != '':
+        commands_file = open(commands_path, 'w', newline='')
+        commands = csv.writer(commands_file, delimiter=';')
+        commands.writerow(['Frame', 'Time', 'Event', 'Throttle', 'Brake', 'SteerAngle', 'Mode',
+                           'X_Position', 'Y_Position', 'Yaw', 'Handler_latency_ms'])
+
+    # Time spent in the telemetry handler for each frame. It doesn't include the socketio/engineio
+    # transport (message encoding, websocket, event dispatch) of a real connection.
+    latencies = np.zeros(frames)
+    wall_start = time.perf_counter()
+    for frame in range(frames):
+        data = source.telemetry()
+        event_count = len(server.events)
+        start = time.perf_counter()
+        drive_rover.telemetry('replay', data)
+        latencies[frame] = (time.perf_counter() - start) * 1000
+        # The handler sends exactly one command per telemetry message
+        event, command = server.events[-1] if len(server.events) > event_count else ('none', None)
+        if commands_file is not None:
+            x, y, yaw = source.position()
+            if event == 'data':
+                controls = [command['throttle'], command['brake'], command['steering_angle']]
+            else:
+                controls = ['', '', '']
+            commands.writerow([frame, round(clock.time, 3), event] + controls +
+                              [session.Rover.mode, x, y, yaw, round(latencies[frame], 3)])
+        source.apply(event, command, dt)
+        clock.time += dt
+    wall_time = time.perf_counter() - wall_start
+    # Write what is still waiting to be recorded
+    session.close()
+    if commands_file is not None:
+        commands_file.close()
+
+    Rover = session.Rover
+    return {
+        'frames': frames,
+        'simulated_time_s': round(frames * dt, 3),
+        'wall_time_s': round(wall_time, 3),
+        'frames_per_second': round(frames / wall_time, 1),
+        'speedup': round(frames * dt / wall_time, 2), # how much faster than real time
+        'handler_latency_ms': {
+            'mean': round(float(np.mean(latencies)), 3),
+            'p50': round(float(np.percentile(latencies, 50)), 3),
+            'p90': round(float(np.percentile(latencies, 90)), 3),
+            'p99': round(float(np.percentile(latencies, 99)), 3),
+            'max': round(float(np.max(latencies)), 3),
+        },
+        'pickups': sum(1 for event, _ in server.events if event == 'pickup'),
+        'samples_found': Rover.samples_found,
+        'perc_mapped': Rover.map_statistics.perc_mapped(),
+        'fidelity': Rover.map_statistics.fidelity(),
+        'time_in_mode_s': Rover.mode_history.totals(),
+        'transitions': Rover.mode_history.count,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Headless replay of telemetry through drive_rover.py. '
+                    'Arguments after "--" are passed to drive_rover.py.')
+    parser.add_argument(
+        '--recording',
+        type=str,
+        default='',
+        help='robot_log.csv to replay. The rover is simulated on the ground truth map when omitted.'
+    )
+    parser.add_argument(
+        '--frames',
+        type=int,
+        default=0,
+        help='Number of telemetry frames (default: the whole recording, or 3000 simulated frames).'
+    )
+    parser.add_argument(
+        '--frame-rate',
+        type=float,
+        default=FRAME_RATE,
+        help='Telemetry frames per second of simulated time.'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed of the sample placement and of the random choices of the decision step.'
+    )
+    parser.add_argument(
+        '--commands',
+        type=str,
+        default='',
+        help='Path of a CSV file where the commands sent back for each frame are recorded.'
+    )
+    parser.add_argument(
+        '--summary',
+        type=str,
+        default='',
+        help='Path of a JSON file where the throughput and handler latency summary is written.'
+    )
+    parser.add_argument(
+        '--resume',
+        type=str,
+        default='',
+        help='Snapshots written by drive_rover.py --snapshots: the simulated rover starts from the state '
+             'of their last frame.'
+    )
+    args, drive_args = parser.parse_known_args()
+    if drive_args[:1] == ['--']:
+        drive_args = drive_args[1:]
+    drive_rover.configure(drive_rover.build_parser().parse_args(drive_args))
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    navigable = ground_truth > 0
+    samples = place_samples(navigable, SAMPLE_COUNT, np.random.RandomState(args.seed))
+    if args.recording != '':
+        source = RecordingReplay(args.recording, samples)
+        frames = min(args.frames, len(source)) if args.frames > 0 else len(source)
+    else:
+        source = MapSimulator(navigable, samples)
+        frames = args.frames if args.frames > 0 else 3000
+
+    resume = None
+    if args.resume != '':
+        if args.recording != '':
+            raise SystemExit('--resume starts the simulated rover from a saved state, '
+                             'it can\'t be used with --recording')
+        resume = state_snapshot.read(args.resume)[-1]
+
+    summary = replay(source, frames, args.frame_rate, args.commands, resume)
+    print(json.dumps(summary, indent=2))
+    if args.summary != '':
+        with open(args.summary, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2)
@@ -0,0 +1,130 @@
+import math
+import threading
+
+# Detections closer than this (meters) to a known rock are taken as the same rock.
+# It is also the size of the buckets of the spatial hash, so a rock within this distance
+# of a position is always in one of the 3 x 3 buckets around it.
+MERGE_RADIUS = 3
+# A picked up rock is the closest known rock within this distance (meters) of the rover
+PICKUP_RADIUS = 3
+
+# A rock seen by the rover: its position is the mean of all its detections, weighted by
+# the number of rock pixels of each detection (a rock seen close up is seen more accurately)
+class RockCandidate():
+    def __init__(self, x, y, weight, time):
+        self.x = x
+        self.y = y
+        self.weight = weight # total number of rock pixels of its detections
+        self.detections = 1
+        self.first_seen = time
+        self.last_seen = time
+        self.collected = False
+
+    def add(self, x, y, weight, time):
+        total = self.weight + weight
+        self.x = (self.x * self.weight + x * weight) / total
+        self.y = (self.y * self.weight + y * weight) / total
+        self.weight = total
+        self.detections += 1
+        self.last_seen = time
+
+# Rocks detected by perception, fused over time: a detection close to a known rock updates it
+# instead of adding a new one. Rocks are kept in a spatial hash of MERGE_RADIUS buckets, so
+# finding the rock near a position only looks at a few buckets whatever the number of rocks.
+# In pipelined mode rocks are added by the perception thread while the decision thread looks
+# for them, so the registry is only used while holding its lock.
+class RockRegistry():
+    def __init__(self, merge_radius=MERGE_RADIUS):
+        self.merge_radius = merge_radius
+        self.candidates = []
+        self.buckets = {} # (bucket x, bucket y) -> candidates whose position is in the bucket
+        self.collected = 0 # number of rocks picked up
+        self.lock = threading.RLock()
+
+    def bucket(self, x, y):
+        return int(math.floor(x / self.merge_radius)), int(math.floor(y / self.merge_radius))
+
+    # Closest known rock within radius (meters, at most merge_radius) of (x, y), or None
+    def find(self, x, y, radius=None, uncollected_only=False, exclude=None):
+        with self.lock:
+            radius = self.merge_radius if radius is None else radius
+            bucket_x, bucket_y = self.bucket(x, y)
+            closest, closest_dist = None, radius
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for candidate in self.buckets.get((bucket_x + dx, bucket_y + dy), ()):
+                        if (uncollected_only and candidate.collected) or candidate is exclude:
+                            continue
+                        dist = math.hypot(candidate.x - x, candidate.y - y)
+                        if dist <= closest_dist:
+                            closest, closest_dist = candidate, dist
+            return closest
+
+    # Add a detection at (x, y) (meters) made of weight rock pixels. Returns its rock.
+    def add(self, x, y, weight, time):
+        with self.lock:
+            candidate = self.find(x, y)
+            if candidate is None:
+                candidate = RockCandidate(x, y, weight, time)
+                self.candidates.append(candidate)
+                self.buckets.setdefault(self.bucket(x, y), []).append(candidate)
+                return candidate
+            self.move(candidate, x, y, weight, time)
+            # The rock may have moved close to another one: both are the same rock
+            other = self.find(candidate.x, candidate.y, exclude=candidate)
+            if other is not None:
+                self.remove(candidate)
+                self.move(other, candidate.x, candidate.y, candidate.weight, candidate.last_seen)
+                other.detections += candidate.detections - 1
+                other.first_seen = min(other.first_seen, candidate.first_seen)
+                other.collected = other.collected or candidate.collected
+                candidate = other
+            return candidate
+
+    # Add a detection to a rock and keep it in the bucket of its new position
+    def move(self, candidate, x, y, weight, time):
+        old_bucket = self.bucket(candidate.x, candidate.y)
+        candidate.add(x, y, weight, time)
+        new_bucket = self.bucket(candidate.x, candidate.y)
+        if new_bucket != old_bucket:
+            self.buckets[old_bucket].remove(candidate)
+            self.buckets.setdefault(new_bucket, []).append(candidate)
+
+    def remove(self, candidate):
+        self.candidates.remove(candidate)
+        self.buckets[self.bucket(candidate.x, candidate.y)].remove(candidate)
+
+    # Mark the rock closest to the rover position as picked up
+    def mark_collected(self, pos):
+        with self.lock:
+            self.collected += 1
+            candidate = self.find(pos[0], pos[1], PICKUP_RADIUS, uncollected_only=True)
+            if candidate is not None:
+                candidate.collected = True
+            return candidate
+
+    # Position (x, y) of the closest rock not picked up yet, or None. There are only a handful of rocks
+    # on the map, so they are all looked at when there is none in the buckets around the position.
+    def nearest_uncollected(self, pos):
+        with self.lock:
+            candidate = self.find(pos[0], pos[1], uncollected_only=True)
+            if candidate is None:
+                remaining = [candidate for candidate in self.candidates if not candidate.collected]
+                if not remaining:
+                    return None
+                candidate = min(remaining,
+                                key=lambda candidate: math.hypot(candidate.x - pos[0], candidate.y - pos[1]))
+            return candidate.x, candidate.y
+
+    def copy(self):
+        with self.lock:
+            registry = RockRegistry(self.merge_radius)
+            for candidate in self.candidates:
+                copied = RockCandidate(candidate.x, candidate.y, candidate.weight, candidate.first_seen)
+                copied.detections = candidate.detections
+                copied.last_seen = candidate.last_seen
+                copied.collected = candidate.collected
+                registry.candidates.append(copied)
+                registry.buckets.setdefault(registry.bucket(copied.x, copied.y), []).append(copied)
+            registry.collected = self.collected
+            return registry
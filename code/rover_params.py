@@ -0,0 +1,27 @@
+# Default decision parameters of a new rover (RoverState in rover_state.py sets its fields from them).
+# They are in their own module, without the server dependencies of drive_rover.py, so offline tools
+# like decision_batch.py can use them.
+# Distances to walls and rocks are in pixels of the top-down view, angles in degrees.
+decision_parameters = {
+    'throttle_set': 0.2, # Throttle setting when accelerating
+    'brake_set': 10, # Brake setting when braking
+    # The stop_forward and go_forward fields below represent total count
+    # of navigable terrain pixels.  This is a very crude form of knowing
+    # when you can keep going and when you should stop.  Feel free to
+    # get creative in adding new fields or modifying these!
+    'stop_forward': 50, # Threshold to initiate stopping
+    'go_forward': 500, # Threshold to go forward again
+    'max_vel': 2, # Maximum velocity (meters/second)
+    # Decision thresholds. decision_batch.py evaluates the decisions for many sets of them at once.
+    'front_wall_near': 25, # Slow down and turn right when the front wall is closer than this
+    'front_wall_too_close': 10, # Stop and turn away when the front wall is closer than this
+    'left_wall_near': 20, # Steer right when the left wall is closer than this
+    'left_wall_too_close': 10,
+    'left_wall_far': 35, # Steer left when the left wall is further than this
+    'right_wall_near': 20, # Steer left when the right wall is closer than this (going home)
+    'right_wall_too_close': 10, # Stop and turn away instead of turning right when closer than this
+    'sample_near': 40, # Stop and approach a rock in sight closer than this...
+    'sample_min_angle': -15, # ...and on the left of this angle
+    'pickup_zone': 15, # Slow down when approaching a rock closer than this
+    'clear_distance': 30, # Turning away is done when the front wall is further than this
+}
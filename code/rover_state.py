@@ -0,0 +1,122 @@
+# State of a rover, shared by the perception and decision steps. It has no dependency on the
+# server (drive_rover.py), so offline tools like benchmark.py can create rovers too.
+import time
+
+import numpy as np
+import matplotlib.image as mpimg
+
+from decision import Mode
+from map_statistics import MapStatistics
+from path_planner import PathPlanner
+from frontier_explorer import FrontierExplorer
+from rock_registry import RockRegistry
+from motion_history import MotionHistory
+from state_machine import ModeHistory
+from occupancy_grid import OccupancyGrid, TiledOccupancyGrid
+from rover_params import decision_parameters
+from telemetry_decoder import TelemetryDecoder
+
+# Read in ground truth map and create 3-channel green version for overplotting
+# NOTE: images are read in by default with the origin (0, 0) in the upper left
+# and y-axis increasing downward.
+ground_truth = mpimg.imread('../calibration_images/map_bw.png')
+# This next line creates arrays of zeros in the red and blue channels
+# and puts the map into the green channel.  This is why the underlying 
+# map output looks green in the display image
+ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float64)
+
+# Define RoverState() class to retain rover state parameters.
+# Its fields are declared in __slots__, which keeps the state compact and makes a typo in a field
+# name an error. Images and maps are preallocated and updated in place; the fields that change
+# from frame to frame can be saved and restored with state_snapshot.SnapshotBuffer.
+class RoverState():
+    __slots__ = ('start_time', 'total_time', 'clock', 'img', 'telemetry_decoder', 'pos', 'yaw', 'pitch', 'roll',
+                 'vel', 'steer', 'throttle', 'brake', 'nav_angles', 'nav_dists', 'mode', 'mode_history',
+                 'throttle_set', 'brake_set', 'stop_forward', 'go_forward', 'max_vel',
+                 'front_wall_near', 'front_wall_too_close', 'left_wall_near', 'left_wall_too_close',
+                 'left_wall_far', 'right_wall_near', 'right_wall_too_close', 'sample_near', 'sample_min_angle',
+                 'pickup_zone', 'clear_distance', 'perception_range', 'vision_labels', 'worldmap', 'ground_truth', 'map_statistics',
+                 'path_planner', 'explorer', 'samples_pos', 'samples_to_find', 'samples_found', 'near_sample',
+                 'picking_up', 'send_pickup', 'starting_pos', 'front_wall_distance', 'left_wall_distance',
+                 'right_wall_distance', 'obstacle_ranges', 'rock_size', 'rock_dist', 'rock_angle', 'rock_pos',
+                 'rock_registry', 'target_rock_pos', 'motion_history', 'spin_back_until', 'status')
+
+    def __init__(self, map_resolution=1, tiled_map=False, frontier_exploration=False, perception_range=None):
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.clock = time.time # Source of the current time (a simulated clock when replaying)
+        self.img = None # Current camera image
+        self.telemetry_decoder = TelemetryDecoder() # Decodes telemetry and camera images
+        self.pos = None # Current position (x, y)
+        self.yaw = None # Current yaw angle
+        self.pitch = None # Current pitch angle
+        self.roll = None # Current roll angle
+        self.vel = None # Current velocity
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav_angles = None # Angles of navigable terrain pixels
+        self.nav_dists = None # Distances of navigable terrain pixels
+        self.mode = Mode.START # Current mode (see decision.Mode)
+        # Transitions between modes and time spent in each of them
+        self.mode_history = ModeHistory(Mode)
+        # Decision parameters and thresholds (throttle_set, max_vel, front_wall_near, ...),
+        # see rover_params.py for their meaning
+        for name, value in decision_parameters.items():
+            setattr(self, name, value)
+        # Only the ground closer than this (meters) is used by the perception step (None for no limit)
+        self.perception_range = perception_range
+        # Label image output from perception step (see perception.classify)
+        # It is rendered with perception.label_colors to display the
+        # intermediate analysis steps on screen in autonomous mode
+        self.vision_labels = np.zeros((160, 320), dtype=np.uint8)
+        # Worldmap
+        # Update this occupancy grid with the positions of navigable terrain
+        # obstacles and rock samples (map_resolution is in cells per meter).
+        # A tiled map is not limited to the 200 x 200 m of the ground truth map
+        if tiled_map:
+            self.worldmap = TiledOccupancyGrid(world_size=200, resolution=map_resolution)
+        else:
+            self.worldmap = OccupancyGrid(world_size=200, resolution=map_resolution)
+        self.ground_truth = self.worldmap.resample(ground_truth_3d) # Ground truth worldmap
+        # Mapped and fidelity statistics of the worldmap, updated along with it
+        self.map_statistics = MapStatistics(self.ground_truth)
+        # Plans the way back to the starting position over the worldmap. Its cost map has the size of
+        # the ground truth map, so there is none with a tiled map (the way home is found by heading
+        # for the starting point then)
+        self.path_planner = None if tiled_map else PathPlanner(self.worldmap)
+        # Chooses where to explore next in travel mode (the left wall is followed without it)
+        self.explorer = FrontierExplorer(self.path_planner) if frontier_exploration else None
+        self.samples_pos = None # To store the actual sample positions
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.samples_found = 0 # To count the number of samples found
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+                
+        # Add-on attributes
+        self.starting_pos = None
+        
+        self.front_wall_distance = 0
+        self.left_wall_distance  = 0
+        self.right_wall_distance = 0
+        # Distance to the closest obstacle in each of perception.range_probe_angles
+        self.obstacle_ranges = None
+        
+        self.rock_size = None
+        self.rock_dist = None
+        self.rock_angle = None
+        self.rock_pos = None 
+    
+        # Rocks detected so far, fused over frames, and which of them were picked up
+        self.rock_registry = RockRegistry()
+        # to keep track of the targetted rock in case it is out of sight.
+        self.target_rock_pos = None
+                
+        # to detect if it gets stuck or is circling
+        self.motion_history = MotionHistory()
+
+        # to keep track of how long it is reversing and turning (time when it stops)
+        self.spin_back_until = None
+
+        self.status = ''
@@ -0,0 +1,191 @@
+# Recording of a run in a single file: the camera image (JPEG, as received) and the state of the
+# rover (state_snapshot record) of every frame, written in chunks of frames by a background thread.
+# The file is read back memory-mapped, with random access to any frame.
+# Example: $ python run_recorder.py ../output/run_000.rover --export ../output/run_dataset
+#          (writes IMG/*.jpg and robot_log.csv, the format of the training mode recordings)
+import argparse
+import csv
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from state_snapshot import snapshot_dtype, to_record
+
+# Number of frames per chunk (a chunk is written at once)
+CHUNK_FRAMES = 64
+# Frames waiting to be written, newer frames are dropped when it is full
+QUEUE_SIZE = 1000
+# A chunk that isn't full is written anyway when no frame comes for this long (seconds)
+FLUSH_INTERVAL = 1.0
+
+# A chunk is a header, the index of its images, the state records of its frames and the JPEG images
+CHUNK_MAGIC = b'ROVERRUN'
+chunk_header_dtype = np.dtype([('magic', 'S8'), ('frames', '<u4'), ('record_size', '<u4'), ('image_bytes', '<u8')])
+image_index_dtype = np.dtype([('offset', '<u8'), ('size', '<u4')]) # offset from the start of the images
+
+# Writes the frames of a run to a new recording file (it is an error if the file already exists,
+# a run is never appended to another one). record() only queues the frame: building and writing
+# the chunks is done by a background thread.
+class RunRecorder():
+    def __init__(self, path, chunk_frames=CHUNK_FRAMES):
+        self.path = path
+        self.output_file = open(path, 'xb')
+        self.chunk_frames = chunk_frames
+        self.frames = queue.Queue(QUEUE_SIZE)
+        self.recorded = 0 # Frames written
+        self.dropped = 0 # Frames dropped because the queue was full
+        self.thread = None
+
+    # Queue the camera image (raw JPEG bytes) and the current state of the rover
+    def record(self, Rover, jpeg):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        try:
+            self.frames.put_nowait((to_record(Rover), jpeg))
+        except queue.Full:
+            self.dropped += 1
+
+    # Write the frames still waiting, stop the background thread and close the file
+    def close(self):
+        if self.thread is not None:
+            self.frames.put(None)
+            self.thread.join()
+            self.thread = None
+        self.output_file.close()
+
+    def write_chunk(self, output_file, frames):
+        records = np.array([record for record, _ in frames], dtype=snapshot_dtype)
+        index = np.zeros(len(frames), dtype=image_index_dtype)
+        index['size'] = [len(jpeg) for _, jpeg in frames]
+        index['offset'][1:] = np.cumsum(index['size'][:-1])
+        header = np.array([(CHUNK_MAGIC, len(frames), snapshot_dtype.itemsize, int(index['size'].sum()))],
+                          dtype=chunk_header_dtype)
+        for array in (header, index, records):
+            output_file.write(memoryview(array).cast('B'))
+        output_file.writelines(jpeg for _, jpeg in frames)
+        output_file.flush()
+        self.recorded += len(frames)
+
+    def run(self):
+        pending = []
+        while True:
+            try:
+                frame = self.frames.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                frame = False # Nothing new for a while
+            if frame:
+                pending.append(frame)
+            if pending and (len(pending) >= self.chunk_frames or not frame):
+                self.write_chunk(self.output_file, pending)
+                pending = []
+            if frame is None:
+                return
+
+# Random access to the frames of a recording. The file is memory-mapped: the records and images
+# are views of the file, only read from disk when they are used. A chunk that was being written
+# when the run stopped is ignored.
+class RunReader():
+    def __init__(self, path):
+        self.path = path
+        if os.path.getsize(path) > 0:
+            self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+        self.chunks = [] # (index of the images, state records, offset of the images) of each chunk
+        offset = 0
+        while offset + chunk_header_dtype.itemsize <= len(self.data):
+            header = np.frombuffer(self.data, chunk_header_dtype, 1, offset)[0]
+            if header['magic'] != CHUNK_MAGIC or header['record_size'] != snapshot_dtype.itemsize:
+                raise ValueError('{} is not a recording of this version of the rover'.format(path))
+            count = int(header['frames'])
+            index_offset = offset + chunk_header_dtype.itemsize
+            records_offset = index_offset + count * image_index_dtype.itemsize
+            images_offset = records_offset + count * snapshot_dtype.itemsize
+            end = images_offset + int(header['image_bytes'])
+            if end > len(self.data):
+                break
+            self.chunks.append((np.frombuffer(self.data, image_index_dtype, count, index_offset),
+                                np.frombuffer(self.data, snapshot_dtype, count, records_offset),
+                                images_offset))
+            offset = end
+        # Number of the first frame of each chunk
+        self.chunk_starts = np.cumsum([0] + [len(records) for _, records, _ in self.chunks])
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    def locate(self, frame):
+        if frame < 0:
+            frame += len(self)
+        if not 0 <= frame < len(self):
+            raise IndexError('Frame {} is not in the recording ({} frames)'.format(frame, len(self)))
+        chunk = int(np.searchsorted(self.chunk_starts, frame, side='right')) - 1
+        return self.chunks[chunk], frame - int(self.chunk_starts[chunk])
+
+    # State record of a frame (see state_snapshot.restore to set a rover to it)
+    def state(self, frame):
+        (_, records, _), position = self.locate(frame)
+        return records[position]
+
+    # Raw JPEG bytes of the camera image of a frame (a view of the file)
+    def jpeg(self, frame):
+        (index, _, images_offset), position = self.locate(frame)
+        start = images_offset + int(index[position]['offset'])
+        return self.data[start:start + int(index[position]['size'])]
+
+    # Camera image of a frame, in RGB like the images given to perception_step
+    def image(self, frame):
+        return cv2.cvtColor(cv2.imdecode(self.jpeg(frame), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+    # State records of all the frames in one array (for offline analysis)
+    def states(self):
+        if not self.chunks:
+            return np.zeros(0, dtype=snapshot_dtype)
+        return np.concatenate([records for _, records, _ in self.chunks])
+
+# Write the frames of a recording as a dataset like the ones recorded in training mode
+# (IMG folder and robot_log.csv), so process_dataset.py can read it
+def export_dataset(reader, folder):
+    image_folder = os.path.join(folder, 'IMG')
+    os.makedirs(image_folder, exist_ok=True)
+    with open(os.path.join(folder, 'robot_log.csv'), 'w', newline='') as log_file:
+        log = csv.writer(log_file, delimiter=';')
+        log.writerow(['Path', 'SteerAngle', 'Throttle', 'Brake', 'Speed',
+                      'X_Position', 'Y_Position', 'Pitch', 'Yaw', 'Roll'])
+        for frame in range(len(reader)):
+            image_path = os.path.join(image_folder, 'frame_{:06d}.jpg'.format(frame))
+            with open(image_path, 'wb') as image_file:
+                image_file.write(reader.jpeg(frame))
+            state = reader.state(frame)
+            log.writerow([image_path, state['steer'], state['throttle'], state['brake'], state['vel'],
+                          state['pos'][0], state['pos'][1], state['pitch'], state['yaw'], state['roll']])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summary of a run recording, optionally exported as a dataset')
+    parser.add_argument(
+        'recording',
+        type=str,
+        help='Recording written by drive_rover.py (.rover file).'
+    )
+    parser.add_argument(
+        '--export',
+        type=str,
+        default='',
+        help='Folder where the frames are written as IMG/*.jpg and robot_log.csv.'
+    )
+    args = parser.parse_args()
+
+    reader = RunReader(args.recording)
+    states = reader.states()
+    print('{} frames in {} chunks'.format(len(reader), len(reader.chunks)))
+    if len(reader) > 0:
+        print('Time: {:.1f} to {:.1f} s, samples found: {}'.format(
+              np.nanmin(states['total_time']), np.nanmax(states['total_time']), states['samples_found'].max()))
+    if args.export != '':
+        export_dataset(reader, args.export)
+        print('Dataset written to {}'.format(args.export))
@@ -0,0 +1,64 @@
+import numpy as np
+
+# Number of transitions kept by ModeHistory
+TRANSITION_HISTORY_SIZE = 256
+
+# Runs the handler of the current mode of the rover, found in a table of
+# mode -> (handler, mode to resume). A handler is called as handler(Rover, resume) and returns
+# the next mode, or None to stay in the current one. Modes that only differ by the mode they go
+# back to when they are done share their handler. Transitions and the time spent in each mode
+# are recorded in Rover.mode_history.
+class StateMachine():
+    def __init__(self, modes, states):
+        self.modes = modes # Enum of the modes, also converts mode names to modes
+        self.states = states
+
+    def step(self, Rover):
+        mode = self.modes(Rover.mode)
+        Rover.mode_history.update(mode, Rover.total_time)
+        handler, resume = self.states[mode]
+        next_mode = handler(Rover, resume)
+        if next_mode is not None and next_mode != mode:
+            Rover.mode_history.record(mode, next_mode, Rover.total_time)
+            Rover.mode = next_mode
+        return Rover
+
+# Time spent in each mode and the last transitions between modes, in fixed size arrays
+# (transitions are kept in a ring buffer), so they can be looked at while running or saved
+# for offline analysis.
+class ModeHistory():
+    def __init__(self, modes, size=TRANSITION_HISTORY_SIZE):
+        self.modes = list(modes)
+        self.mode_index = {mode: index for index, mode in enumerate(self.modes)}
+        self.size = size
+        self.time = np.zeros(size) # time of each transition
+        self.source = np.zeros(size, dtype=np.int8) # mode index before and after each transition
+        self.target = np.zeros(size, dtype=np.int8)
+        self.count = 0 # number of transitions since the start (the last size are kept)
+        self.time_in_mode = np.zeros(len(self.modes)) # total time spent in each mode (seconds)
+        self.last_update = None
+
+    # Count the time since the last step as spent in the current mode
+    def update(self, mode, time):
+        if self.last_update is not None and time > self.last_update:
+            self.time_in_mode[self.mode_index[mode]] += time - self.last_update
+        self.last_update = time
+
+    def record(self, source, target, time):
+        i = self.count % self.size
+        self.time[i] = time
+        self.source[i] = self.mode_index[source]
+        self.target[i] = self.mode_index[target]
+        self.count += 1
+
+    # Transitions made since the first one numbered start (oldest first, at most size of them):
+    # list of (time, mode before, mode after)
+    def transitions(self, start=0):
+        start = max(start, self.count - self.size)
+        indices = np.arange(start, self.count) % self.size
+        return [(float(self.time[i]), self.modes[self.source[i]], self.modes[self.target[i]]) for i in indices]
+
+    # Total time spent in each mode (seconds), by mode name
+    def totals(self):
+        return {str(mode): round(float(seconds), 3) for mode, seconds in zip(self.modes, self.time_in_mode)
+                if seconds > 0}
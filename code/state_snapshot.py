@@ -0,0 +1,144 @@
+# Saving of the state of the rover on the last frames, written by drive_rover.py --snapshots.
+# Example: $ python state_snapshot.py ../output/snapshots/<sid>.snapshots --last 20
+#          (prints the state of the rover on the last 20 frames before it disconnected or failed)
+import argparse
+
+import numpy as np
+from decision import Mode
+from perception import range_probe_angles
+
+# Number of snapshots kept by SnapshotBuffer (40 s at 25 FPS, a snapshot is 338 bytes)
+SNAPSHOT_COUNT = 1024
+
+# Modes are saved by index
+modes = list(Mode)
+mode_index = {mode: index for index, mode in enumerate(modes)}
+
+# Fields of the rover that change from frame to frame, as one fixed size record.
+# Optional values (None until known) are saved as NaN. The maps, the camera image and the
+# histories are not part of it: they are preallocated buffers updated in place.
+snapshot_dtype = np.dtype([
+    ('total_time', 'f8'),
+    ('pos', 'f8', (2,)),
+    ('yaw', 'f8'),
+    ('pitch', 'f8'),
+    ('roll', 'f8'),
+    ('vel', 'f8'),
+    ('steer', 'f8'),
+    ('throttle', 'f8'),
+    ('brake', 'f8'),
+    ('mode', 'i1'),
+    ('samples_to_find', 'i1'),
+    ('samples_found', 'i1'),
+    ('near_sample', 'i1'),
+    ('picking_up', 'i1'),
+    ('send_pickup', '?'),
+    ('starting_pos', 'f8', (2,)),
+    ('front_wall_distance', 'f8'),
+    ('left_wall_distance', 'f8'),
+    ('right_wall_distance', 'f8'),
+    ('obstacle_ranges', 'f8', (len(range_probe_angles),)),
+    ('rock_size', 'i4'),
+    ('rock_dist', 'f8'),
+    ('rock_angle', 'f8'),
+    ('rock_pos', 'f8', (2,)),
+    ('target_rock_pos', 'f8', (2,)),
+    ('spin_back_until', 'f8'),
+])
+
+# Fields that can be None, and the value they are saved as then
+optional_fields = {
+    'total_time': np.nan, 'pos': (np.nan, np.nan), 'yaw': np.nan, 'pitch': np.nan, 'roll': np.nan,
+    'vel': np.nan, 'starting_pos': (np.nan, np.nan), 'obstacle_ranges': np.nan, 'rock_size': 0,
+    'rock_dist': np.nan, 'rock_angle': np.nan, 'rock_pos': (np.nan, np.nan),
+    'target_rock_pos': (np.nan, np.nan), 'spin_back_until': np.nan,
+}
+
+def to_record(Rover):
+    values = []
+    for field in snapshot_dtype.names:
+        value = getattr(Rover, field)
+        if field == 'mode':
+            value = mode_index[Mode(value)]
+        elif value is None:
+            value = optional_fields[field]
+        values.append(value)
+    return tuple(values)
+
+# Fields saved as integers
+integer_fields = ['samples_to_find', 'samples_found', 'near_sample', 'picking_up', 'rock_size']
+
+def is_missing(value):
+    return np.isnan(value).all() if np.ndim(value) > 0 else np.isnan(value)
+
+# Set the fields of the rover from a record (a row of an array of snapshot_dtype)
+def restore(Rover, record):
+    for field, value in zip(snapshot_dtype.names, record.item()):
+        if field == 'mode':
+            value = modes[value]
+        elif field == 'send_pickup':
+            value = bool(value)
+        elif field in integer_fields:
+            value = int(value)
+        elif is_missing(value):
+            value = None
+        elif field == 'obstacle_ranges':
+            value = value.copy()
+        elif field == 'pos':
+            value = [float(value[0]), float(value[1])] # a list, like update_rover sets it
+        elif np.ndim(value) > 0:
+            value = (float(value[0]), float(value[1]))
+        else:
+            value = float(value)
+        setattr(Rover, field, value)
+
+# Snapshots of the rover on the last frames, in a preallocated array of records used as a ring buffer.
+# Saving a frame writes one record in place. The array is a single block of memory: it can be
+# written to a file or a socket as is (see write) and read back without conversion (see read).
+class SnapshotBuffer():
+    def __init__(self, size=SNAPSHOT_COUNT):
+        self.size = size
+        self.records = np.zeros(size, dtype=snapshot_dtype)
+        self.count = 0 # number of snapshots saved since the start (the last size are kept)
+
+    # Save the current state of the rover
+    def save(self, Rover):
+        self.records[self.count % self.size] = to_record(Rover)
+        self.count += 1
+
+    # Write the snapshots still in the buffer, oldest first, without copying them
+    def write(self, output_file):
+        start = self.count % self.size if self.count > self.size else 0
+        used = min(self.count, self.size)
+        for begin, end in ((start, used), (0, start)):
+            if end > begin:
+                output_file.write(memoryview(self.records[begin:end]).cast('B'))
+
+# Snapshots written by SnapshotBuffer.write, as an array of records backed by the file
+def read(path):
+    return np.memmap(path, dtype=snapshot_dtype, mode='r')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='States of the rover on the last frames of a snapshots file')
+    parser.add_argument(
+        'snapshots',
+        type=str,
+        help='Snapshots written by drive_rover.py --snapshots (.snapshots file).'
+    )
+    parser.add_argument(
+        '--last',
+        type=int,
+        default=25,
+        help='Number of frames printed, from the end.'
+    )
+    args = parser.parse_args()
+
+    records = read(args.snapshots)
+    print('{} frames'.format(len(records)))
+    print('{:>8} {:>19} {:>8} {:>8} {:>6} {:>6} {:>6} {:>6} {:>7}'.format(
+          'time', 'mode', 'x', 'y', 'yaw', 'vel', 'steer', 'thr', 'samples'))
+    for record in records[-args.last:]:
+        print('{:8.2f} {:>19} {:8.2f} {:8.2f} {:6.1f} {:6.2f} {:6.1f} {:6.2f} {:7d}'.format(
+              record['total_time'], modes[record['mode']].value, record['pos'][0], record['pos'][1],
+              record['yaw'], record['vel'], record['steer'], record['throttle'], record['samples_found']))
@@ -3,129 +3,131 @@ import cv2
 from PIL import Image
 from io import BytesIO, StringIO
 import base64
-import time
+from perception import label_colors
+from occupancy_grid import crop_to_display
 
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
       if ',' in string_to_convert:
-            float_value = np.float(string_to_convert.replace(',','.'))
+            float_value = float(string_to_convert.replace(',','.'))
       else: 
-            float_value = np.float(string_to_convert)
+            float_value = float(string_to_convert)
       return float_value
 
 def update_rover(Rover, data):
+      decoder = Rover.telemetry_decoder
       # Initialize start time and sample positions
       if Rover.start_time == None:
-            Rover.start_time = time.time()
+            Rover.start_time = Rover.clock()
             Rover.total_time = 0
-            samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
-            samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
+            samples_xpos = np.int_(decoder.parse_list(data["samples_x"]))
+            samples_ypos = np.int_(decoder.parse_list(data["samples_y"]))
             Rover.samples_pos = (samples_xpos, samples_ypos)
-            Rover.samples_to_find = np.int(data["sample_count"])
+            Rover.samples_to_find = int(data["sample_count"])
       # Or just update elapsed time
       else:
-            tot_time = time.time() - Rover.start_time
+            tot_time = Rover.clock() - Rover.start_time
             if np.isfinite(tot_time):
                   Rover.total_time = tot_time
-      # Print out the fields in the telemetry data dictionary
-      print(data.keys())
+      # Parse all numeric fields at once (see telemetry_decoder.numeric_fields)
+      speed, xpos, ypos, yaw, pitch, roll, throttle, steer, near_sample, picking_up, sample_count = \
+            decoder.parse(data).tolist()
       # The current speed of the rover in m/s
-      Rover.vel = convert_to_float(data["speed"])
+      Rover.vel = speed
       # The current position of the rover
-      Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
+      Rover.pos = [xpos, ypos]
       # The current yaw angle of the rover
-      Rover.yaw = convert_to_float(data["yaw"])
-      # The current yaw angle of the rover
-      Rover.pitch = convert_to_float(data["pitch"])
-      # The current yaw angle of the rover
-      Rover.roll = convert_to_float(data["roll"])
+      Rover.yaw = yaw
+      # The current pitch angle of the rover
+      Rover.pitch = pitch
+      # The current roll angle of the rover
+      Rover.roll = roll
       # The current throttle setting
-      Rover.throttle = convert_to_float(data["throttle"])
+      Rover.throttle = throttle
       # The current steering angle
-      Rover.steer = convert_to_float(data["steering_angle"])
+      Rover.steer = steer
       # Near sample flag
-      Rover.near_sample = np.int(data["near_sample"])
+      Rover.near_sample = int(near_sample)
       # Picking up flag
-      Rover.picking_up = np.int(data["picking_up"])
+      Rover.picking_up = int(picking_up)
       # Update number of rocks found
-      Rover.samples_found = Rover.samples_to_find - np.int(data["sample_count"])
-
-      print('speed =',Rover.vel, 'position =', Rover.pos, 'throttle =', 
-      Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
-      'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
-      'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
-      'samples found:', Rover.samples_found, 'mode: ', Rover.mode, 'front_wall_distance: ', Rover.front_wall_distance,
-      'starting_pos:', Rover.starting_pos, 'status:', Rover.status, 'unmoveable_counter:', Rover.unmoveable_counter, 
-      'continuous_steer_counter:', Rover.continuous_steer_counter)
+      Rover.samples_found = Rover.samples_to_find - int(sample_count)
+
       # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
+      # (converted to RGB into the same buffer on every frame)
+      Rover.img = decoder.decode_image(data["image"])
 
-      # Return updated Rover and separate image for optional saving
-      return Rover, image
+      # Return updated Rover and the raw JPEG image for optional saving
+      return Rover, decoder.jpeg
 
-# Define a function to create display output given worldmap results
-def create_output_images(Rover):
+# Define a function to render the worldmap over the ground truth map for display
+def render_worldmap(worldmap, ground_truth):
 
       # Create a scaled map for plotting and clean up obs/nav pixels a bit
-      if np.max(Rover.worldmap[:,:,2]) > 0:
-            nav_pix = Rover.worldmap[:,:,2] > 0
-            navigable = Rover.worldmap[:,:,2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
+      if np.max(worldmap[:,:,2]) > 0:
+            nav_pix = worldmap[:,:,2] > 0
+            navigable = worldmap[:,:,2] * (255 / np.mean(worldmap[nav_pix, 2]))
       else: 
-            navigable = Rover.worldmap[:,:,2]
-      if np.max(Rover.worldmap[:,:,0]) > 0:
-            obs_pix = Rover.worldmap[:,:,0] > 0
-            obstacle = Rover.worldmap[:,:,0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
+            navigable = worldmap[:,:,2]
+      if np.max(worldmap[:,:,0]) > 0:
+            obs_pix = worldmap[:,:,0] > 0
+            obstacle = worldmap[:,:,0] * (255 / np.mean(worldmap[obs_pix, 0]))
       else:
-            obstacle = Rover.worldmap[:,:,0]
+            obstacle = worldmap[:,:,0]
 
       likely_nav = navigable >= obstacle
       obstacle[likely_nav] = 0
-      plotmap = np.zeros_like(Rover.worldmap)
+      plotmap = np.zeros(worldmap.shape, dtype=np.float64)
       plotmap[:, :, 0] = obstacle
       plotmap[:, :, 2] = navigable
       plotmap = plotmap.clip(0, 255)
       # Overlay obstacle and navigable terrain map with ground truth map
-      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
-
-      # Check whether any rock detections are present in worldmap
-      rock_world_pos = Rover.worldmap[:,:,1].nonzero()
-      # If there are, we'll step through the known sample positions
-      # to confirm whether detections are real
-      if rock_world_pos[0].any():
-            rock_size = 2
+      map_add = cv2.addWeighted(plotmap, 1, ground_truth, 0.5, 0)
+
+      return map_add, plotmap
+
+# Define a function to create display output given worldmap results
+def create_output_images(Rover):
+
+      # Get the part of the worldmap to display (the whole map, or an overview of
+      # the explored area for tiled maps) and the matching part of the ground truth
+      grid = Rover.worldmap
+      display_size = int(round(grid.world_size * grid.resolution))
+      worldmap, origin_x, origin_y, step = grid.display_map(display_size)
+      ground_truth = crop_to_display(Rover.ground_truth, origin_x, origin_y, step, worldmap.shape)
+      map_add, plotmap = render_worldmap(worldmap, ground_truth)
+
+      # Step through the known sample positions to confirm whether detections are real:
+      # if a rock was detected within 3 meters of a known sample position consider it
+      # a success and plot the location of the known sample on the map
+      if Rover.samples_pos is not None:
+            cells_per_pixel = grid.resolution / step
+            rock_size = max(int(round(2 * cells_per_pixel)), 1)
             for idx in range(len(Rover.samples_pos[0])):
-                  test_rock_x = Rover.samples_pos[0][idx]
-                  test_rock_y = Rover.samples_pos[1][idx]
-                  rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
-                                        (test_rock_y - rock_world_pos[0])**2)
-                  # If rocks were detected within 3 meters of known sample positions
-                  # consider it a success and plot the location of the known
-                  # sample on the map
-                  if np.min(rock_sample_dists) < 3:
-                        map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
-
-      # Calculate some statistics on the map results
-      # First get the total number of pixels in the navigable terrain map
-      tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
-      # Next figure out how many of those correspond to ground truth pixels
-      good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-      # Next find how many do not correspond to ground truth pixels
-      bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
-      # Grab the total number of map pixels
-      tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
-      # Calculate the percentage of ground truth map that has been successfully found
-      perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
-      # Calculate the number of good map pixel detections divided by total pixels 
-      # found to be navigable terrain
-      if tot_nav_pix > 0:
-            fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
-      else:
-            fidelity = 0
+                  if Rover.rock_registry.find(Rover.samples_pos[0][idx], Rover.samples_pos[1][idx], 3) is None:
+                        continue
+                  # Sample positions are in meters, convert them to display pixels
+                  test_rock_x = int((Rover.samples_pos[0][idx] * grid.resolution - origin_x) / step)
+                  test_rock_y = int((Rover.samples_pos[1][idx] * grid.resolution - origin_y) / step)
+                  map_add[max(test_rock_y-rock_size, 0):test_rock_y+rock_size, 
+                  max(test_rock_x-rock_size, 0):test_rock_x+rock_size, :] = 255
+      # Display the map at 1 pixel per meter whatever the map resolution
+      if map_add.shape[0] == map_add.shape[1] and map_add.shape[0] != grid.world_size:
+            map_add = cv2.resize(map_add, (grid.world_size, grid.world_size), interpolation=cv2.INTER_AREA)
+      # Overviews of tiled maps are not square, put them on a square display
+      elif map_add.shape[0] != map_add.shape[1]:
+            display = np.zeros((grid.world_size, grid.world_size, 3), dtype=map_add.dtype)
+            rows = min(map_add.shape[0], grid.world_size)
+            cols = min(map_add.shape[1], grid.world_size)
+            display[:rows, :cols] = map_add[:rows, :cols]
+            map_add = display
+
+      # Get the statistics on the map results (kept up to date by perception_step)
+      perc_mapped = Rover.map_statistics.perc_mapped()
+      fidelity = Rover.map_statistics.fidelity()
       # Flip the map for plotting so that the y-axis points upward in the display
-      map_add = np.flipud(map_add).astype(np.float32)
+      # (as 8 bit pixels, cv2.putText only draws on those)
+      map_add = np.flipud(map_add).clip(0, 255).astype(np.uint8)
       # Add some text about map and rock sample detection results
       cv2.putText(map_add,"Time: "+str(np.round(Rover.total_time, 1))+' s', (0, 10), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
@@ -137,12 +139,12 @@ def create_output_images(Rover):
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
 
       # Convert map and vision image to base64 strings for sending to server
-      pil_img = Image.fromarray(map_add.astype(np.uint8))
+      pil_img = Image.fromarray(map_add)
       buff = BytesIO()
       pil_img.save(buff, format="JPEG")
       encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
       
-      pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
+      pil_img = Image.fromarray(label_colors[Rover.vision_labels])
       buff = BytesIO()
       pil_img.save(buff, format="JPEG")
       encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
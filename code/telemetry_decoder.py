@@ -0,0 +1,64 @@
+import base64
+import time
+import numpy as np
+import cv2
+
+# Numeric telemetry fields, in the order they come out of TelemetryDecoder.parse
+# ("position" holds 2 values: x;y)
+numeric_fields = ['speed', 'position', 'yaw', 'pitch', 'roll', 'throttle',
+                  'steering_angle', 'near_sample', 'picking_up', 'sample_count']
+
+# Decodes the telemetry messages sent by the simulator.
+# Camera frames are converted to RGB into the same preallocated image buffer on every frame,
+# so the decoded image is only valid until the next call to decode_image. The JPEG decoder itself
+# still allocates its (BGR) output every frame: cv2.imdecode can't decode into an existing array
+# from Python.
+class TelemetryDecoder():
+    def __init__(self, img_shape=(160, 320, 3)):
+        self.image = np.zeros(img_shape, dtype=np.uint8) # Reused camera image buffer (RGB)
+        self.jpeg = None # Raw JPEG bytes of the last camera image (for saving)
+        self.decode_time = 0 # Time spent decoding the last camera image (seconds)
+        self.parse_time = 0 # Time spent parsing the last numeric fields (seconds)
+        # Running totals to report average times
+        self.total_decode_time = 0
+        self.total_parse_time = 0
+        self.decode_count = 0
+        self.parse_count = 0
+
+    # Parse all numeric fields at once, independent of decimal convention
+    def parse(self, data):
+        start = time.perf_counter()
+        joined = ';'.join([data[field] for field in numeric_fields])
+        values = np.array(joined.replace(',', '.').split(';'), dtype=np.float64)
+        self.parse_time = time.perf_counter() - start
+        self.total_parse_time += self.parse_time
+        self.parse_count += 1
+        return values
+
+    # Parse a ';' separated list of numbers (like "samples_x"), independent of decimal convention
+    def parse_list(self, string_to_parse):
+        return np.array(string_to_parse.replace(',', '.').split(';'), dtype=np.float64)
+
+    # Decode a base64 JPEG camera image, the RGB image is written into the reused image buffer
+    def decode_image(self, img_string):
+        start = time.perf_counter()
+        self.jpeg = base64.b64decode(img_string)
+        bgr = cv2.imdecode(np.frombuffer(self.jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if bgr.shape != self.image.shape:
+            self.image = np.zeros(bgr.shape, dtype=np.uint8)
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=self.image)
+        self.decode_time = time.perf_counter() - start
+        self.total_decode_time += self.decode_time
+        self.decode_count += 1
+        return self.image
+
+    # Average decode and parse times (milliseconds) since the last reset
+    def average_times(self, reset=False):
+        decode_ms = 1000 * self.total_decode_time / max(self.decode_count, 1)
+        parse_ms = 1000 * self.total_parse_time / max(self.parse_count, 1)
+        if reset:
+            self.total_decode_time = 0
+            self.total_parse_time = 0
+            self.decode_count = 0
+            self.parse_count = 0
+        return decode_ms, parse_ms
@@ -0,0 +1,102 @@
+import json
+import queue
+import threading
+import time
+import numpy as np
+
+# Verbosity levels
+QUIET   = 0 # nothing
+SUMMARY = 1 # once per second summaries (FPS, timings)
+FRAMES  = 2 # summaries and the rover state of every (sampled) frame
+
+# Rover state fields recorded in frame records
+frame_fields = ['total_time', 'mode', 'status', 'vel', 'pos', 'yaw', 'pitch', 'roll',
+                'throttle', 'brake', 'steer', 'near_sample', 'picking_up', 'send_pickup',
+                'samples_found', 'starting_pos', 'front_wall_distance', 'left_wall_distance',
+                'right_wall_distance', 'rock_size', 'rock_dist', 'rock_angle', 'rock_pos']
+
+# Maximum number of records waiting to be written, newer records are dropped when it is full
+QUEUE_SIZE = 10000
+
+# JSON encoding of numpy values found in the rover state
+def to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+# Structured logger for the telemetry loop: records are queued by the control loop and
+# written as JSON lines, in batches, by a background thread. Summary records are also
+# printed to the console. Nothing is ever written from the control loop itself.
+class TelemetryLogger():
+    def __init__(self, path='', verbosity=SUMMARY, sample_every=1, console=True, batch_size=100):
+        self.path = path # JSON lines file ('' to only print summaries to the console)
+        self.verbosity = verbosity
+        self.sample_every = sample_every # Record 1 frame out of this many
+        self.console = console
+        self.batch_size = batch_size
+        self.frame_count = 0
+        self.dropped = 0 # Records dropped because the queue was full
+        self.records = queue.Queue(QUEUE_SIZE)
+        self.thread = None
+
+    def configure(self, path='', verbosity=SUMMARY, sample_every=1):
+        self.path = path
+        self.verbosity = verbosity
+        self.sample_every = max(sample_every, 1)
+
+    # Queue a record of the given kind if the verbosity allows it
+    def log(self, kind, level, **fields):
+        if level > self.verbosity:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        fields['kind'] = kind
+        fields['time'] = time.time()
+        try:
+            self.records.put_nowait(fields)
+        except queue.Full:
+            self.dropped += 1
+
+    # Once per second summary (FPS, timings...)
+    def summary(self, **fields):
+        self.log('summary', SUMMARY, **fields)
+
+    # State of the rover for the current frame (1 frame out of sample_every), plus extra fields
+    def frame(self, Rover, **fields):
+        self.frame_count += 1
+        if self.verbosity < FRAMES or (self.frame_count - 1) % self.sample_every != 0:
+            return
+        state = {field: getattr(Rover, field, None) for field in frame_fields}
+        # pos may be updated in place later on, record its current values
+        if state['pos'] is not None:
+            state['pos'] = list(state['pos'])
+        state.update(fields)
+        self.log('frame', FRAMES, frame=self.frame_count, **state)
+
+    def run(self):
+        log_file = None
+        while True:
+            batch = [self.records.get()]
+            # Take everything that is already waiting, up to a batch
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if self.path != '':
+                if log_file is None:
+                    log_file = open(self.path, 'a')
+                log_file.write(''.join(json.dumps(record, default=to_json) + '\n' for record in batch))
+                log_file.flush()
+            if self.console:
+                for record in batch:
+                    if record['kind'] == 'summary':
+                        print(' '.join('{}: {}'.format(key, value) for key, value in record.items()
+                                       if key not in ('kind', 'time')))
+
+
+# Logger shared by the telemetry loop
+logger = TelemetryLogger()
@@ -0,0 +1,236 @@
+# Telemetry sources for headless runs (replay_rover.py, benchmark.py), in the format the simulator
+# sends: either a recording replayed as is (open loop: the rover follows the recording whatever the
+# commands are) or a rover simulated on the ground truth map (closed loop).
+import base64
+import csv
+import os
+
+import cv2
+import numpy as np
+
+from perception import get_camera_model, dst_size
+from process_dataset import find_image
+from supporting_functions import convert_to_float
+
+# Telemetry rate of the simulated rover (frames per second of simulated time)
+FRAME_RATE = 25
+# Number of rock samples placed on the map
+SAMPLE_COUNT = 6
+# Where the rover starts in the simulator (position in meters, yaw in degrees)
+START_POS = (99.7, 85.6)
+START_YAW = 56.8
+
+# Ground texture of the simulated world (pixels per meter, same scale as the warped camera image)
+TEXTURE_SCALE = 2 * dst_size
+GROUND_COLOR = (170, 150, 130) # navigable terrain
+WALL_COLOR = (90, 70, 60) # obstacles and everything outside of the map
+ROCK_COLOR = (170, 150, 30)
+SKY_COLOR = (60, 60, 70)
+ROCK_RADIUS = 0.4 # meters
+
+# Rough dynamics of the simulated rover
+ACCELERATION = 10 # m/s^2 at full throttle
+DRAG = 0.5 # 1/s
+TURN_RATE = 3 # degrees per second, per degree of steering
+NEAR_SAMPLE_DISTANCE = 1.5 # meters
+PICKUP_TIME = 2 # seconds
+
+# Define a function to place rock samples on random navigable cells of the map
+def place_samples(navigable, count, rng):
+    ypos, xpos = navigable.nonzero()
+    chosen = rng.choice(len(xpos), count, replace=False)
+    return xpos[chosen] + 0.5, ypos[chosen] + 0.5
+
+# Define a function to encode an RGB camera image the way the simulator sends it
+def encode_image(img):
+    _, jpeg = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+    return base64.b64encode(jpeg.tobytes()).decode('ascii')
+
+# Clock of the replay, used as Rover.clock
+class SimulatedClock():
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+# Telemetry of a recording (robot_log.csv + IMG folder). Commands are ignored.
+class RecordingReplay():
+    def __init__(self, log_path, samples):
+        log_dir = os.path.dirname(os.path.abspath(log_path))
+        with open(log_path) as log_file:
+            self.rows = list(csv.DictReader(log_file, delimiter=';'))
+        for row in self.rows:
+            row['Path'] = find_image(row['Path'], log_dir)
+        self.samples = samples
+        self.index = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def position(self):
+        row = self.rows[self.index]
+        return convert_to_float(row['X_Position']), convert_to_float(row['Y_Position']), \
+               convert_to_float(row['Yaw'])
+
+    def telemetry(self):
+        row = self.rows[self.index]
+        with open(row['Path'], 'rb') as image_file:
+            image = base64.b64encode(image_file.read()).decode('ascii')
+        return {
+            'speed': row['Speed'],
+            'position': '{};{}'.format(row['X_Position'], row['Y_Position']),
+            'yaw': row['Yaw'],
+            'pitch': row['Pitch'],
+            'roll': row['Roll'],
+            'throttle': row['Throttle'],
+            'steering_angle': row['SteerAngle'],
+            'brake': row['Brake'],
+            'near_sample': '0',
+            'picking_up': '0',
+            'sample_count': str(len(self.samples[0])),
+            'samples_x': ';'.join(str(x) for x in self.samples[0]),
+            'samples_y': ';'.join(str(y) for y in self.samples[1]),
+            'image': image,
+        }
+
+    def apply(self, event, data, dt):
+        self.index += 1
+
+# Rover simulated on the ground truth map: the camera image is rendered from a textured
+# version of the map, and the commands drive a simple kinematic model that stops at obstacles
+class MapSimulator():
+    def __init__(self, navigable, samples, img_shape=(160, 320, 3)):
+        self.navigable = navigable
+        self.samples = samples
+        self.collected = np.zeros(len(samples[0]), dtype=bool)
+        self.img_shape = img_shape
+        self.x, self.y = START_POS
+        self.yaw = START_YAW
+        self.vel = 0.0
+        self.throttle = 0.0
+        self.brake = 0.0
+        self.steer = 0.0
+        self.near_sample = 0
+        self.picking_up = 0
+        self.pickup_time = 0
+
+        # Textured world, indexed like the ground truth map ([y, x])
+        nav_texture = cv2.resize(navigable.astype(np.uint8), None, fx=TEXTURE_SCALE, fy=TEXTURE_SCALE,
+                                 interpolation=cv2.INTER_NEAREST) > 0
+        self.texture = np.where(nav_texture[:,:,None], np.uint8(GROUND_COLOR), np.uint8(WALL_COLOR))
+        for sample_x, sample_y in zip(*samples):
+            self.draw_sample(sample_x, sample_y, ROCK_COLOR)
+
+        # Rover-centric position (meters) of the ground seen by each camera pixel,
+        # by projecting the camera pixels with the perspective transform of perception_step
+        camera = get_camera_model(img_shape)
+        rows, cols = img_shape[:2]
+        ypos, xpos = np.mgrid[0:rows, 0:cols]
+        points = camera.M.dot(np.stack((xpos.ravel(), ypos.ravel(), np.ones(rows * cols))))
+        front = np.sign(camera.M.dot(np.append(camera.source[0], 1))[2])
+        self.ground_index = np.flatnonzero(points[2] * front > 0) # pixels below the horizon
+        warped_x = points[0, self.ground_index] / points[2, self.ground_index]
+        warped_y = points[1, self.ground_index] / points[2, self.ground_index]
+        self.x_rover = (rows - warped_y) / TEXTURE_SCALE
+        self.y_rover = -(warped_x - rows) / TEXTURE_SCALE
+        self.image = np.zeros(img_shape, dtype=np.uint8)
+
+    def draw_sample(self, sample_x, sample_y, color):
+        center = (int(sample_x * TEXTURE_SCALE), int(sample_y * TEXTURE_SCALE))
+        cv2.circle(self.texture, center, int(ROCK_RADIUS * TEXTURE_SCALE), color, -1)
+
+    def position(self):
+        return self.x, self.y, self.yaw
+
+    # Camera image at the current position
+    def render(self):
+        yaw = np.radians(self.yaw)
+        x_world = self.x_rover * np.cos(yaw) - self.y_rover * np.sin(yaw) + self.x
+        y_world = self.x_rover * np.sin(yaw) + self.y_rover * np.cos(yaw) + self.y
+        x_texture = np.int_(np.floor(x_world * TEXTURE_SCALE))
+        y_texture = np.int_(np.floor(y_world * TEXTURE_SCALE))
+        inside = (x_texture >= 0) & (x_texture < self.texture.shape[1]) \
+               & (y_texture >= 0) & (y_texture < self.texture.shape[0])
+        pixels = self.image.reshape(-1, 3)
+        pixels[:] = SKY_COLOR
+        pixels[self.ground_index] = WALL_COLOR
+        pixels[self.ground_index[inside]] = self.texture[y_texture[inside], x_texture[inside]]
+        return self.image
+
+    def telemetry(self):
+        return {
+            'speed': str(self.vel),
+            'position': '{};{}'.format(self.x, self.y),
+            'yaw': str(self.yaw),
+            'pitch': '0',
+            'roll': '0',
+            'throttle': str(self.throttle),
+            'steering_angle': str(self.steer),
+            'brake': str(self.brake),
+            'near_sample': str(self.near_sample),
+            'picking_up': str(self.picking_up),
+            'sample_count': str(np.count_nonzero(~self.collected)),
+            'samples_x': ';'.join(str(x) for x in self.samples[0]),
+            'samples_y': ';'.join(str(y) for y in self.samples[1]),
+            'image': encode_image(self.render()),
+        }
+
+    def is_navigable(self, x, y):
+        return 0 <= x < self.navigable.shape[1] and 0 <= y < self.navigable.shape[0] \
+               and self.navigable[int(y), int(x)]
+
+    # Apply a command and move the rover forward in time by dt seconds.
+    # Controls stay as they are until the next "data" command, like in the simulator.
+    def apply(self, event, data, dt):
+        if event == 'data':
+            self.throttle = convert_to_float(data['throttle'])
+            self.brake = convert_to_float(data['brake'])
+            self.steer = convert_to_float(data['steering_angle'])
+        elif event == 'pickup' and self.near_sample and not self.picking_up:
+            self.picking_up = 1
+            self.pickup_time = PICKUP_TIME
+
+        if self.picking_up:
+            self.vel = 0.0
+            self.pickup_time -= dt
+            if self.pickup_time <= 0:
+                self.picking_up = 0
+                self.collect_nearest_sample()
+        else:
+            if self.brake > 0:
+                self.vel -= np.sign(self.vel) * min(abs(self.vel), self.brake * dt)
+            else:
+                self.vel += (self.throttle * ACCELERATION - self.vel * DRAG) * dt
+            self.yaw = (self.yaw + self.steer * TURN_RATE * dt) % 360
+            yaw = np.radians(self.yaw)
+            next_x = self.x + self.vel * dt * np.cos(yaw)
+            next_y = self.y + self.vel * dt * np.sin(yaw)
+            if self.is_navigable(next_x, next_y):
+                self.x, self.y = next_x, next_y
+            else:
+                self.vel = 0.0 # ran into an obstacle
+
+        self.near_sample = int(self.nearest_sample_distance()[1] < NEAR_SAMPLE_DISTANCE)
+
+    # Put the rover at a position, stopped
+    def move_to(self, pos, yaw):
+        self.x, self.y = pos
+        self.yaw = yaw
+        self.vel = 0.0
+        self.near_sample = int(self.nearest_sample_distance()[1] < NEAR_SAMPLE_DISTANCE)
+
+    # Index of the closest sample that hasn't been collected yet, and its distance
+    def nearest_sample_distance(self):
+        if self.collected.all():
+            return None, np.inf
+        dists = np.hypot(self.samples[0] - self.x, self.samples[1] - self.y)
+        dists[self.collected] = np.inf
+        nearest = np.argmin(dists)
+        return nearest, dists[nearest]
+
+    def collect_nearest_sample(self):
+        nearest, dist = self.nearest_sample_distance()
+        if dist < NEAR_SAMPLE_DISTANCE:
+            self.collected[nearest] = True
+            self.draw_sample(self.samples[0][nearest], self.samples[1][nearest], GROUND_COLOR)